@@ -3,11 +3,30 @@ from inflateutils.surface import *
 import inflateutils.svgpath.shader as shader
 import inflateutils.svgpath.parser as parser
 import sys
+import os
+import cmath
+import hashlib
+import shutil
+import tempfile
 import getopt
+import time
+import copy
+from array import array
 from inflateutils.exportmesh import *
+from inflateutils.decimate import decimateMesh
+from inflateutils.heightmap import saveHeightmap, FORMATS as HEIGHTMAP_FORMATS
 
 quiet = False
 
+# fraction of a time budget that the planned stages may use; the rest covers parsing, output and misprediction
+BUDGET_SAFETY = 0.8
+
+# vertices closer than this fraction of the grid spacing are welded together after trimming
+WELD_EPSILON = 1e-6
+
+# outlines match as instances if their canonical forms agree to this fraction of their size
+INSTANCE_PRECISION = 1e-6
+
 def getBounds(lines):
     bottom = min(min(l[0].imag,l[1].imag) for l in lines)
     left = min(min(l[0].real,l[1].real) for l in lines)
@@ -69,12 +88,25 @@ def rasterizePolygon(polygon, gridSize, shadeMode=shader.Shader.MODE_EVEN_ODD, h
 def message(string):
     if not quiet:
         sys.stderr.write(string + "\n")
+        
+def setQuiet(value):
+    global quiet
+    old = quiet
+    quiet = value
+    return old
     
 def inflatePolygon(polygon, gridSize=15, shadeMode=shader.Shader.MODE_EVEN_ODD, inflationParams=None,
-        center=False, twoSided=False, color=None):
+        center=False, twoSided=False, color=None, timings=None, solverCallback=None, solverCallbackInterval=10, 
+        adaptiveTolerance=None, levels=None, heightmap=False):
     # polygon is described by list of (start,stop) pairs, where start and stop are complex numbers
+    # if heightmap is set, the solved MeshData is returned without meshing
+    # if levels is a list of subsampling factors, the solved surface is meshed once for each, and a list of meshes is returned
+    # if adaptiveTolerance is set, flat areas get coarser triangles that are within that distance of the surface
+    # if timings is a dict, it gets filled with the number of edges and grid cells and with the seconds spent in each stage
+    t0 = time.time()
     message("Rasterizing")
     meshData = rasterizePolygon(polygon, gridSize, shadeMode=shadeMode, hex=inflationParams.hex)
+    t1 = time.time()
     
     def distanceToEdge(z0, direction):
         direction = direction / abs(direction)
@@ -117,62 +149,112 @@ def inflatePolygon(polygon, gridSize=15, shadeMode=shader.Shader.MODE_EVEN_ODD,
         for i in range(len(deltasComplex)):
             map[x][y][i] = distanceToEdge( v.toComplex(), deltasComplex[i] )
             
+    t2 = time.time()
     message("Inflating")
     
     def distanceFunction(col, row, i, map=map):
         return map[col][row][i]
     
-    inflateRaster(meshData, inflationParams=inflationParams, distanceToEdge=distanceFunction)
+    inflateRaster(meshData, inflationParams=inflationParams, distanceToEdge=distanceFunction, 
+        callback=solverCallback, callbackInterval=solverCallbackInterval)
+    t3 = time.time()
+    if heightmap:
+        return meshData
     message("Meshing")
    
-    mesh0 = meshData.getMesh(twoSided=twoSided, color=color)
-    
-    def fixFace(face, polygon):
-        # TODO: optimize by using cached data from the distance map
-        def trimLine(start, stop):
-            delta = (stop - start).toComplex() # projects to 2D
-            if delta == 0j:
-                return stop
-            length = abs(delta)
-            z0 = start.toComplex()
-            distance = distanceToEdge(z0, delta)
-            if distance < length:
-                z = z0 + distance * delta / length
-                return Vector(z.real, z.imag, 0)
-            else:
-                return stop
-    
-        outsideCount = sum(1 for v in face if not meshData.insideCoordinates(v))
-        if outsideCount == 3:
-            # should not ever happen
-            return []
-        elif outsideCount == 0:
-            return [face]
-        elif outsideCount == 2:
-            if meshData.insideCoordinates(face[1]):
-                face = (face[1], face[2], face[0])
-            elif meshData.insideCoordinates(face[2]):
-                face = (face[2], face[0], face[1])
-            # now, the first vertex is inside and the others are outside
-            return [ (face[0], trimLine(face[0], face[1]), trimLine(face[0], face[2])) ]
-        else: # outsideCount == 1
-            if not meshData.insideCoordinates(face[0]):
-                face = (face[1], face[2], face[0])
-            elif not meshData.insideCoordinates(face[1]):
-                face = (face[2], face[0], face[1])
-            # now, the first two vertices are inside, and the third is outside
-            closest0 = trimLine(face[0], face[2])
-            closest1 = trimLine(face[1], face[2])
-            if closest0 != closest1:
-                return [ (face[0], face[1], closest0), (closest0, face[1], closest1) ]
-            else:
-                return [ (face[0], face[1], closest0) ]
+    def makeMesh(meshData):
+        # trims and closes the top surface over meshData
+        mesh = IndexedMesh(color=color)
+        # the faces are trimmed as they are made, so the untrimmed surface is never stored
+        if adaptiveTolerance:
+            faces = meshData.generateAdaptiveFaces(mesh, adaptiveTolerance)
+        else:
+            faces = meshData.generateFaces(mesh)
+        inside = {}
+        trimmed = {}
+    
+        def isInside(i):
+            try:
+                return inside[i]
+            except KeyError:
+                inside[i] = meshData.insideCoordinates(mesh.getVertex(i))
+                return inside[i]
+    
+        def fixFace(face, polygon):
+            # TODO: optimize by using cached data from the distance map
+            def trimLine(start, stop):
+                # faces sharing an edge share its trimmed vertex
+                try:
+                    return trimmed[(start,stop)]
+                except KeyError:
+                    pass
+                startVector = mesh.getVertex(start)
+                delta = (mesh.getVertex(stop) - startVector).toComplex() # projects to 2D
+                if delta == 0j:
+                    return stop
+                length = abs(delta)
+                z0 = startVector.toComplex()
+                distance = distanceToEdge(z0, delta)
+                if distance < length:
+                    z = z0 + distance * delta / length
+                    i = mesh.addVertex(z.real, z.imag, 0)
+                else:
+                    i = stop
+                trimmed[(start,stop)] = i
+                return i
+    
+            outsideCount = sum(1 for v in face if not isInside(v))
+            if outsideCount == 3:
+                # should not ever happen
+                return []
+            elif outsideCount == 0:
+                return [face]
+            elif outsideCount == 2:
+                if isInside(face[1]):
+                    face = (face[1], face[2], face[0])
+                elif isInside(face[2]):
+                    face = (face[2], face[0], face[1])
+                # now, the first vertex is inside and the others are outside
+                return [ (face[0], trimLine(face[0], face[1]), trimLine(face[0], face[2])) ]
+            else: # outsideCount == 1
+                if not isInside(face[0]):
+                    face = (face[1], face[2], face[0])
+                elif not isInside(face[1]):
+                    face = (face[2], face[0], face[1])
+                # now, the first two vertices are inside, and the third is outside
+                closest0 = trimLine(face[0], face[2])
+                closest1 = trimLine(face[1], face[2])
+                if closest0 != closest1 and mesh.getVertex(closest0) != mesh.getVertex(closest1):
+                    return [ (face[0], face[1], closest0), (closest0, face[1], closest1) ]
+                else:
+                    return [ (face[0], face[1], closest0) ]
 
-    message("Fixing outer faces")
-    mesh = []
-    for rgb,face in mesh0:
-        for face2 in fixFace(face, polygon):
-            mesh.append((rgb, face2))
+        for face in faces:
+            for face2 in fixFace(face, polygon):
+                mesh.addFace(*face2)
+        # different outline edges can trim to the same point up to rounding
+        mesh.weld(WELD_EPSILON * meshData.getDeltaLength(0,0,0))
+        if twoSided:
+            mesh.addMirror()
+        else:
+            mesh.addBottomCap()
+        return mesh
+        
+    if levels is None:
+        mesh = makeMesh(meshData)
+    else:
+        mesh = [ makeMesh(meshData if level == 1 else meshData.subsample(level)) for level in levels ]
+            
+    if timings is not None:
+        timings["edges"] = len(polygon)
+        timings["cols"] = meshData.cols
+        timings["rows"] = meshData.rows
+        timings["cells"] = meshData.cols * meshData.rows
+        timings["masked"] = sum(1 for p in meshData.getPoints())
+        timings["rasterize"] = t1-t0
+        timings["distance"] = t2-t1
+        timings["inflate"] = t3-t2
+        timings["mesh"] = time.time()-t3
             
     return mesh
     
@@ -186,62 +268,354 @@ def sortedApproximatePaths(paths,error=0.1):
         
     return sorted(paths, key=key)
 
-def inflateLinearPath(path, gridSize=15, inflationParams=None, ignoreColor=False, offset=0j):
+def getInstanceKey(lines, fillRule):
+    """
+    Returns (key, center, direction) for a polygon given as (start,stop) pairs, where key is the
+    same for polygons that are the same up to translation, rotation and uniform scaling, whatever 
+    vertex they start at and whichever way they run, and (z-center)/direction maps the polygon to 
+    that canonical form. Returns None for a degenerate polygon.
+    
+    The direction is the vertex farthest from the center, with ties broken by whichever gives the
+    smallest canonical form, and the key is a digest of the sorted, rounded edges in that frame.
+    """
+    points = [ z for line in lines for z in line ]
+    if not points:
+        return None
+    center = sum(points) / len(points)
+    radius = max(abs(z - center) for z in points)
+    if radius == 0:
+        return None
+    scale = 1. / INSTANCE_PRECISION
+    
+    def canonicalEdges(direction):
+        edges = []
+        for line in lines:
+            a,b = ( (z - center) / direction for z in line )
+            a = (int(round(a.real * scale)), int(round(a.imag * scale)))
+            b = (int(round(b.real * scale)), int(round(b.imag * scale)))
+            edges.append(a + b if a <= b else b + a)
+        edges.sort()
+        return edges
+        
+    best = None
+    for candidate in set(z - center for z in points if abs(z - center) >= radius * (1. - INSTANCE_PRECISION)):
+        edges = canonicalEdges(candidate)
+        if best is None or edges < best:
+            best = edges
+            direction = candidate
+    data = array('i', (x for edge in best for x in edge))
+    digest = hashlib.sha1(data.tostring() if sys.version_info[0] < 3 else data.tobytes()).digest()
+    return (fillRule, digest), center, direction
+    
+class MeshInstance(object):
+    """
+    Marks a mesh as the mesh named sourceName with x+iy mapped to rotation*(x+iy)+translation.
+    """
+    def __init__(self, sourceName, rotation, translation):
+        self.sourceName = sourceName
+        self.rotation = rotation
+        self.translation = translation
+
+def inflateLinearPath(path, gridSize=15, inflationParams=None, twoSided=False, ignoreColor=False, offset=0j, timings=None,
+        solverCallback=None, solverCallbackInterval=10, adaptiveTolerance=None, levels=None, heightmap=False):
     lines = []
     for line in path:
         lines.append((line.start+offset,line.end+offset))
     mode = shader.Shader.MODE_NONZERO if path.svgState.fillRule == 'nonzero' else shader.Shader.MODE_EVEN_ODD
     return inflatePolygon(lines, gridSize=gridSize, inflationParams=inflationParams, twoSided=twoSided, 
-                color=None if ignoreColor else path.svgState.fill, shadeMode=mode) 
+                color=None if ignoreColor else path.svgState.fill, shadeMode=mode, timings=timings,
+                solverCallback=solverCallback, solverCallbackInterval=solverCallbackInterval, adaptiveTolerance=adaptiveTolerance,
+                levels=levels, heightmap=heightmap) 
 
 class InflatedData(object):
     pass
+    
+class BudgetPlan(object):
+    def __init__(self, gridSize, iterations, costs, solveCosts):
+        self.gridSize = gridSize
+        self.iterations = iterations # None for the default iteration count
+        self.costs = costs # predicted seconds for each path
+        self.solveCosts = solveCosts # predicted seconds for the solver part of each path
+    
+def planTimeBudget(paths, seconds, inflationParams, twoSided=False, offset=0j, 
+        calibrationSize=8, calibrationIterations=10, maxGridSize=1000):
+    """
+    Picks the largest resolution (and then iteration count) whose predicted running time fits in seconds.
+    
+    Each path is inflated once on a calibrationSize grid with calibrationIterations iterations. The
+    rasterizer costs (grid cells) x (edges), the distance map and the meshing cost (masked cells) x (edges),
+    and the solver costs (masked cells) x (iterations). The edge count does not depend on the resolution 
+    and the cell counts grow with its square, so the calibration timings extrapolate to any resolution.
+    """
+    quietSave = setQuiet(True)
+    params = copy.copy(inflationParams)
+    params.iterations = calibrationIterations
+    params.deadline = None
+    samples = []
+    try:
+        for path in paths:
+            timings = {}
+            inflateLinearPath(path, gridSize=calibrationSize, inflationParams=params, twoSided=twoSided, offset=offset, timings=timings)
+            samples.append(timings)
+    finally:
+        setQuiet(quietSave)
+        
+    def predict(gridSize, iterations):
+        scale = (gridSize / calibrationSize) ** 2
+        costs = []
+        solveCosts = []
+        for t in samples:
+            masked = max(t["masked"], 1)
+            perRasterCell = t["rasterize"] / (t["cells"] * t["edges"])
+            perDistanceCell = t["distance"] / (masked * t["edges"])
+            perSolverCell = t["inflate"] / (masked * calibrationIterations)
+            perMeshCell = t["mesh"] / masked
+            if iterations is None:
+                # default of inflateRaster() is 25 * max(cols,rows), and the side grows linearly with resolution
+                n = 25 * max(t["cols"], t["rows"]) * gridSize / calibrationSize
+            else:
+                n = iterations
+            cells = t["cells"] * scale
+            masked *= scale
+            solve = perSolverCell * masked * n
+            solveCosts.append(solve)
+            costs.append(perRasterCell * cells * t["edges"] + perDistanceCell * masked * t["edges"] + solve + perMeshCell * masked)
+        return costs, solveCosts
+        
+    def fits(gridSize, iterations):
+        return sum(predict(gridSize, iterations)[0]) <= seconds
+        
+    def largest(lo, hi, ok):
+        # largest n in [lo,hi] with ok(n), or lo if there is none; ok must be monotone
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if ok(mid):
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+        
+    iterations = inflationParams.iterations
+    gridSize = largest(calibrationSize, maxGridSize, lambda n : fits(n, iterations))
+    if not fits(gridSize, iterations):
+        # even the calibration grid is too slow, so cut down on the iterations instead
+        if iterations is None:
+            iterations = 25 * max(max(t["cols"], t["rows"]) for t in samples)
+        iterations = largest(1, iterations, lambda n : fits(gridSize, n))
+        
+    costs, solveCosts = predict(gridSize, iterations)
+    return BudgetPlan(gridSize, iterations, costs, solveCosts)
                 
-def inflatePaths(paths, gridSize=15, inflationParams=None, twoSided=False, ignoreColor=False, baseName="path", offset=0j, colors=True):
-    data = InflatedData()
-    data.meshes = []
+def getInflatedBounds(paths, inflationParams, twoSided=False, offset=0j):
+    """
+    Returns (minVector, maxVector) bounding the meshes that generateInflatedPaths() will make of
+    the linear paths, without inflating them.
+    """
+    lines = [ (line.start+offset, line.end+offset) for path in paths if path.svgState.fill is not None for line in path ]
+    if not lines:
+        return None
+    left,bottom,right,top = getBounds(lines)
+    height = inflationParams.thickness + inflationParams.noise
+    return Vector(left,bottom,-height if twoSided else 0.), Vector(right,top,height)
 
-    paths = sortedApproximatePaths( paths, error=0.1 )
+def inflatePaths(*args, **kwargs):
+    """
+    Takes the same arguments as generateInflatedPaths() and returns an InflatedData object whose
+    meshes member is the list of (name,mesh) pairs.
+    """
+    data = InflatedData()
+    data.meshes = list(generateInflatedPaths(*args, **kwargs))
+    return data
+                
+def generateInflatedPaths(paths, gridSize=15, inflationParams=None, twoSided=False, ignoreColor=False, baseName="path", offset=0j, colors=True,
+        deadline=None, solverCallback=None, solverCallbackInterval=10, adaptiveTolerance=None, 
+        decimateFaces=None, decimateError=None, linear=False, levels=None, heightmap=False, instancing=False):
+    """
+    Inflates the filled paths one at a time, yielding a (name,mesh) pair for each, so that only one 
+    mesh needs to be in memory at a time.
+    
+    deadline: if not None, a time.time() value by which the inflation should be done; the resolution and 
+              iteration count are then chosen by planTimeBudget() and gridSize and inflationParams.iterations
+              are ignored
+    solverCallback: if not None, called as solverCallback(name, iteration, ...) with the name of the mesh
+              being inflated followed by the arguments documented in inflateRaster()
+    adaptiveTolerance: if not None, merge flat areas into larger triangles within this many millimeters
+              of the surface
+    decimateFaces, decimateError: if either is not None, simplify each mesh with decimateMesh() down to 
+              that many faces or as far as possible within that many millimeters
+    linear: the paths are already the output of sortedApproximatePaths()
+    levels: if not None, a list of subsampling factors; each path is then solved once and meshed on 
+              a grid with every factor-th point for each factor, yielding one pair per level in order,
+              with "_lod" and the factor appended to the name
+    heightmap: if set, yield the solved MeshData (see getHeightGrid()) for each path instead of a mesh
+    instancing: if set, a path that is a translated, rotated or uniformly scaled copy of an earlier one
+              (see getInstanceKey()) is not inflated again; its meshes are copies of the earlier path's,
+              transformed, with an instance member (a MeshInstance) naming the mesh they were made from;
+              ignored with heightmap or noise, as the noise differs between copies
+    """
+    if not linear:
+        paths = sortedApproximatePaths( paths, error=0.1 )
+    
+    if deadline is not None:
+        inflationParams = copy.copy(inflationParams)
+        filled = [path for path in paths if path.svgState.fill is not None]
+        plan = planTimeBudget(filled, (deadline - time.time()) * BUDGET_SAFETY, inflationParams, twoSided=twoSided, offset=offset)
+        message("Time budget: resolution %d, %s iterations" % (plan.gridSize, plan.iterations if plan.iterations else "default"))
+        gridSize = plan.gridSize
+        inflationParams.iterations = plan.iterations
+        costs = plan.costs
+        solveCosts = plan.solveCosts
+        
+    if instancing and not heightmap and not inflationParams.noise:
+        # canonical form -> (meshes, center, direction) of the first path with it
+        instances = {}
+    else:
+        instances = None
     
     for i,path in enumerate(paths):
         inflateThis = path.svgState.fill is not None
         if inflateThis:
-            mesh = inflateLinearPath(path, gridSize=gridSize, inflationParams=inflationParams, ignoreColor=not colors, offset=offset)
+            if deadline is not None:
+                # give this path's solver its share of the remaining time, leaving room for the other stages
+                share = (deadline - time.time()) * costs[0] / max(sum(costs), 1e-9)
+                inflationParams.deadline = time.time() + share - (costs[0] - solveCosts[0])
+                costs = costs[1:]
+                solveCosts = solveCosts[1:]
             name = "inflated_" + baseName
             if len(paths)>1:
                 name += "_" + str(i+1)
-            data.meshes.append( (name, mesh) )
-
-    return data
+            if instances is not None:
+                key = getInstanceKey([ (line.start+offset, line.end+offset) for line in path ], path.svgState.fillRule)
+            else:
+                key = None
+            if key is not None and key[0] in instances:
+                sourceMeshes, center, direction = instances[key[0]]
+                rotation = key[2] / direction
+                translation = key[1] - rotation * center
+                message("Instancing %s" % sourceMeshes[0][0])
+                for j,(sourceName,sourceMesh) in enumerate(sourceMeshes):
+                    mesh = sourceMesh.copy()
+                    mesh.transformXY(rotation, translation)
+                    mesh.color = path.svgState.fill if colors else None
+                    mesh.instance = MeshInstance(sourceName, rotation, translation)
+                    yield (name if levels is None else name + "_lod" + str(levels[j])), mesh
+                continue
+            if solverCallback is not None:
+                callback = lambda *args, **kwargs : solverCallback(name, *args, **kwargs)
+            else:
+                callback = None
+            mesh = inflateLinearPath(path, gridSize=gridSize, inflationParams=inflationParams, twoSided=twoSided, ignoreColor=not colors, offset=offset,
+                        solverCallback=callback, solverCallbackInterval=solverCallbackInterval, adaptiveTolerance=adaptiveTolerance,
+                        levels=levels, heightmap=heightmap)
+            if heightmap:
+                yield name, mesh
+                continue
+            if levels is None:
+                meshes = [ (name, mesh) ]
+            else:
+                meshes = [ (name + "_lod" + str(level), levelMesh) for level,levelMesh in zip(levels, mesh) ]
+            finished = []
+            for name,mesh in meshes:
+                if decimateFaces is not None or decimateError is not None:
+                    message("Decimating")
+                    mesh = decimateMesh(mesh, targetFaces=decimateFaces, maxError=decimateError)
+                finished.append((name, mesh))
+                yield name, mesh
+            if key is not None:
+                instances[key[0]] = (finished, key[1], key[2])
     
-def recenterMesh(mesh):
-    leftX = float("inf")
-    rightX = float("-inf")
-    topX = float("-inf")
-    bottomX = float("inf")
-    
-    for rgb,triangle in mesh:
-        for vertex in triangle:
-            leftX = min(leftX, vertex[0])
-            rightX = max(rightX, vertex[0])
-            bottomX = min(bottomX, vertex[1])
-            topX = max(topX, vertex[1])
-
-    newMesh = []
+def validateMeshes(meshes):
+    """
+    Passes (name,mesh) pairs through, exiting with an error message at the first mesh that is
+    not closed and manifold.
+    """
+    for name,mesh in meshes:
+        openEdges,nonManifold = mesh.checkManifold()
+        if openEdges or nonManifold:
+            sys.stderr.write("Invalid mesh %s: %d open edges, %d non-manifold edges\n" % (name, len(openEdges), len(nonManifold)))
+            sys.exit(1)
+        message("Mesh %s is valid: %d triangles" % (name, mesh.numFaces()))
+        yield name,mesh
     
-    center = Vector(0.5*(leftX+rightX),0.5*(bottomX+topX),0.)
+def saveInflatedSCAD(outfile, meshes, levels=None, importSTL=False):
+    """
+    Writes the (name,mesh) pairs from generateInflatedPaths() as an OpenSCAD file (or to stdout if
+    outfile is None) with center, size and color variables and a module for each mesh.
     
-    for rgb,triangle in mesh:
-        newMesh.append((rgb, tuple(v-center for v in triangle)))
+    If importSTL is set, each mesh is saved as a binary STL file next to outfile (which must then
+    be given), named after the output file and the mesh, and its module import()s it.
+    
+    The module of a mesh with an instance member (see generateInflatedPaths()) draws the module of 
+    the mesh it was made from with multmatrix() instead.
+    
+    The variables come first, so the modules are spooled to a temporary file as the meshes arrive.
+    """
+    variables = []
+    names = []
+    centers = {}
+    spool = tempfile.TemporaryFile("w+")
+    try:
+        for name,mesh in meshes:
+            instance = getattr(mesh, "instance", None)
+            mesh,centerX,centerY,width,height = recenterMesh(mesh)
+            names.append(name)
+            centers[name] = complex(centerX, centerY)
+            variables.append("center_%s = [%s,%s];\n" % (name,decimal(centerX),decimal(centerY)))
+            variables.append("size_%s = [%s,%s];\n" % (name,decimal(width),decimal(height)))
+            variables.append("color_%s = %s;\n\n" % (name,describeColor(getColorFromMesh(mesh))))
+            if instance is not None and instance.sourceName in centers:
+                # both modules are centered, so map the source's center to this one's
+                r = instance.rotation
+                t = instance.translation + r * centers[instance.sourceName] - centers[name]
+                # rounding to the printed precision first, so that adding 0. turns what would print as -0 into 0
+                matrix = tuple(decimal(round(x, 9) + 0.) for x in (r.real, -r.imag, t.real, r.imag, r.real, t.imag))
+                spool.write("module %s() {\n  multmatrix([[%s,%s,0,%s],[%s,%s,0,%s],[0,0,1,0]]) " % ((name,) + matrix))
+                spool.write("%s();\n}\n\n" % instance.sourceName)
+            elif importSTL:
+                stlName = os.path.splitext(outfile)[0] + "_" + name + ".stl"
+                saveSTL(stlName, mesh, quiet=quiet, mono=True, positive=False)
+                # OpenSCAD looks for the file next to the .scad file
+                path = os.path.basename(stlName).replace("\\","\\\\").replace('"','\\"')
+                spool.write('module %s() {\n  import("%s");\n}\n\n' % (name, path))
+            else:
+                for chunk in generateSCADModule(mesh, moduleName=name, digitsAfterDecimal=5, colorOverride=""):
+                    spool.write(chunk)
+                spool.write("\n")
+            
+        if levels is not None:
+            # only show the first level of detail of each path
+            names = names[::len(levels)]
+            
+        with OutputWriter(outfile) as f:
+            for line in variables:
+                f.write(line)
+            spool.seek(0)
+            shutil.copyfileobj(spool, f)
+            for name in names:
+                f.write("translate(center_%s) color(color_%s) %s();\n" % (name,name,name))
+            if not outfile:
+                # as print() would have
+                f.write("\n")
+    finally:
+        spool.close()
+    
+def recenterMesh(mesh):
+    if not mesh.numVertices():
+        return mesh.copy(), 0., 0., 0., 0.
+    lower,upper = mesh.getBounds()
+    center = Vector(0.5*(lower.x+upper.x),0.5*(lower.y+upper.y),0.)
+    
+    newMesh = mesh.copy()
+    newMesh.translate(-center)
         
-    return newMesh, center.x, center.y, rightX-leftX, topX-bottomX
+    return newMesh, center.x, center.y, upper.x-lower.x, upper.y-lower.y
     
 def getColorFromMesh(mesh):
-    return mesh[0][0]
+    return mesh.color
     
 if __name__ == '__main__':
-    import cmath
     
+    startTime = time.time()
     params = InflationParams()
     output = "stl"
     twoSided = False
@@ -251,12 +625,27 @@ if __name__ == '__main__':
     colors = True
     clamp = 0
     centerPage = False
+    timeBudget = None
+    traceFile = None
+    traceInterval = 10
+    adaptiveTolerance = None
+    decimateFaces = None
+    decimateError = None
+    levels = None
+    heightmapFormat = None
+    validate = False
+    instancing = False
+    importSTL = False
     
     def help(exitCode=0):
         help = """python inflatemesh.py [options] filename.svg
 options:
 --help:         this message        
 --stl:          output to STL (default: OpenSCAD)
+--3mf:          output to 3MF, with one colored object per path (default: OpenSCAD)
+--ply:          output to binary PLY, with vertex colors (default: OpenSCAD)
+--obj:          output to OBJ, with one object per path and vertex colors (default: OpenSCAD)
+--glb:          output to binary glTF for web previews, with one colored mesh per path (default: OpenSCAD)
 --rectangular:  use mesh over rectangular grid (default: hexagonal)
 --flatness=x:   make the top flatter; reasonable range: 0.0-10.0 (default: 0.0)
 --height=x:     inflate to height (or thickness) x millimeters (default: 10)
@@ -265,6 +654,31 @@ options:
 --exponent=x:   controls how rounded the inflated image is; must be bigger than 0.0 (default: 0.0)
 --resolution=n: approximate mesh resolution along the larger dimension (default: 15)
 --iterations=n: number of iterations in calculation (default depends on resolution)
+--time-budget=x: choose the resolution and iterations to finish in about x seconds, stopping the
+                inflation early if needed; --resolution is then ignored
+--trace-solver=file.csv: write solver progress (residuals, height, active cells) to a CSV file
+--trace-interval=n: iterations between solver progress records (default: 10)
+--adaptive=x:   use larger triangles where the surface is flat to within x millimeters (default: off);
+                the cells along the outline keep the full resolution, so this saves most at high
+                resolutions with large flat areas (about 3 times fewer triangles at resolution 60
+                and 5 times at 120 for a clamped shape)
+--decimate=n:   simplify each inflated path down to about n triangles (default: off)
+--decimate-error=x: simplify each inflated path as far as possible without moving the surface by
+                more than x millimeters; with --decimate, stops at whichever comes first (default: off)
+--lod=n1,n2,...: solve once and mesh the result at several levels of detail, using every n-th grid point
+                for each n (1 is the full resolution); the OpenSCAD file gets a module for each level
+                and shows the first, while STL output goes to one file per level, named by adding
+                _lod<n> to the --output filename (likewise for 3MF, PLY and OBJ)
+--heightmap=format: instead of a mesh, write the inflated heights on a regular grid, as a 16-bit grayscale
+                png, raw little-endian float32 (with the grid size and scale in a .json file next to it)
+                or the OpenSCAD surface() dat format; needs --output, and with several paths, 
+                writes one file per path, adding the path number to the filename
+--scad-import:  save each mesh as a binary STL file next to the OpenSCAD file (named after it and
+                the mesh) and import() it there instead of writing out the polyhedron; needs --output
+--validate:     check that every mesh is closed and manifold, and stop with an error if one is not
+--instance:     inflate a path that is a translated, rotated or uniformly scaled copy of an earlier one
+                by transforming the earlier one's mesh instead of inflating it again; the OpenSCAD
+                file then draws the copy's module with multmatrix() (ignored with --noise)
 --two-sided:    inflate both up and down
 --no-colors:    omit colors from SVG file (default: include colors)
 --center-page:  put the center of the SVG page at (0,0,0) in the OpenSCAD file
@@ -279,10 +693,10 @@ options:
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], "h", 
-                        ["tab=", "help", "stl", "rectangular", "mesh=", "flatness=", "name=", "height=", 
+                        ["tab=", "help", "stl", "3mf", "ply", "obj", "glb", "rectangular", "mesh=", "flatness=", "name=", "height=", 
                         "exponent=", "resolution=", "format=", "iterations=", "width=", "xtwo-sided=", "two-sided", 
                         "output=", "center-page", "xcenter-page=", "no-colors", "xcolors=", "noise=", "noise-exponent=",
-                        "clamp="
+                        "clamp=", "time-budget=", "trace-solver=", "trace-interval=", "adaptive=", "decimate=", "decimate-error=", "lod=", "heightmap=", "validate", "scad-import", "instance"
                         ])
 
         if len(args) == 0:
@@ -312,8 +726,42 @@ options:
                 format = arg.replace('"','').replace("'","")
             elif opt == "--stl":
                 format = "stl"
+            elif opt == "--3mf":
+                format = "3mf"
+            elif opt == "--ply":
+                format = "ply"
+            elif opt == "--obj":
+                format = "obj"
+            elif opt == "--glb":
+                format = "glb"
             elif opt == '--iterations':
                 params.iterations = int(arg)
+            elif opt == '--time-budget':
+                timeBudget = float(arg)
+            elif opt == '--trace-solver':
+                traceFile = arg
+            elif opt == '--trace-interval':
+                traceInterval = int(arg)
+            elif opt == '--adaptive':
+                adaptiveTolerance = float(arg)
+            elif opt == '--decimate':
+                decimateFaces = int(arg)
+            elif opt == '--decimate-error':
+                decimateError = float(arg)
+            elif opt == '--heightmap':
+                heightmapFormat = arg.lower()
+                if heightmapFormat not in HEIGHTMAP_FORMATS:
+                    raise getopt.GetoptError("heightmap format must be one of: " + ", ".join(HEIGHTMAP_FORMATS))
+            elif opt == '--scad-import':
+                importSTL = True
+            elif opt == '--validate':
+                validate = True
+            elif opt == '--instance':
+                instancing = True
+            elif opt == '--lod':
+                levels = [int(level) for level in arg.split(",")]
+                if min(levels) < 1:
+                    raise getopt.GetoptError("levels of detail must be positive")
             elif opt == '--width':
                 width = float(arg)
             elif opt == '--xtwo-sided':
@@ -345,6 +793,18 @@ options:
         help(exitCode=1)
         sys.exit(2)
         
+    if heightmapFormat is not None and not outfile:
+        sys.stderr.write("--heightmap needs --output\n")
+        sys.exit(2)
+        
+    if importSTL and not outfile:
+        sys.stderr.write("--scad-import needs --output\n")
+        sys.exit(2)
+        
+    if levels is not None and format in ('stl', '3mf', 'ply', 'obj', 'glb') and not outfile:
+        sys.stderr.write("Mesh file output with --lod needs --output\n")
+        sys.exit(2)
+        
     if twoSided:
         params.thickness *= 0.5
         
@@ -355,28 +815,65 @@ options:
     else:
         offset = 0j
         
-    data = inflatePaths(paths, inflationParams=params, gridSize=gridSize, twoSided=twoSided, baseName=baseName, offset=offset, colors=colors)
+    if traceFile:
+        trace = open(traceFile, "w")
+        trace.write("path,iteration,seconds,max_residual,rms_residual,max_height,active_cells,stopped_by_deadline\n")
+        def traceSolver(name, iteration, elapsed, maxResidual, rmsResidual, maxHeight, activeCells, stopped):
+            trace.write("%s,%d,%.6f,%.9g,%.9g,%.9g,%d,%d\n" % (name, iteration, elapsed, maxResidual, rmsResidual, maxHeight, activeCells, stopped))
+            trace.flush()
+    else:
+        traceSolver = None
+        
+    paths = sortedApproximatePaths(paths, error=0.1)
+    meshes = generateInflatedPaths(paths, inflationParams=params, gridSize=gridSize, twoSided=twoSided, baseName=baseName, offset=offset, colors=colors,
+                deadline=None if timeBudget is None else startTime + timeBudget, 
+                solverCallback=traceSolver, solverCallbackInterval=traceInterval, adaptiveTolerance=adaptiveTolerance,
+                decimateFaces=decimateFaces, decimateError=decimateError, linear=True, levels=levels,
+                heightmap=heightmapFormat is not None, instancing=instancing)
     
-    if format == 'stl':
-        mesh = [datum for name,mesh in data.meshes for datum in mesh]
-        saveSTL(outfile, mesh, quiet=quiet)
+    if validate and heightmapFormat is None:
+        meshes = validateMeshes(meshes)
+    
+    # the output is written on a background thread while the next path is inflated
+    if heightmapFormat is not None:
+        count = sum(1 for path in paths if path.svgState.fill is not None)
+        base,ext = os.path.splitext(outfile)
+        def writeOutput(meshes):
+            for i,(name,meshData) in enumerate(meshes):
+                saveHeightmap(outfile if count == 1 else base + "_" + str(i+1) + ext, meshData, format=heightmapFormat, quiet=quiet)
+    elif format in ('stl', '3mf', 'ply', 'obj', 'glb'):
+        if format == 'stl':
+            bounds = getInflatedBounds(paths, params, twoSided=twoSided, offset=offset)
+            def save(filename, meshes):
+                saveSTL(filename, (mesh for name,mesh in meshes), quiet=quiet, bounds=bounds, mono=not colors)
+        elif format == '3mf':
+            def save(filename, meshes):
+                save3MF(filename, meshes, quiet=quiet)
+        elif format == 'ply':
+            def save(filename, meshes):
+                savePLY(filename, [mesh for name,mesh in meshes], quiet=quiet)
+        elif format == 'glb':
+            def save(filename, meshes):
+                saveGLB(filename, meshes, quiet=quiet)
+        else:
+            def save(filename, meshes):
+                meshes = list(meshes)
+                saveOBJ(filename, [mesh for name,mesh in meshes], quiet=quiet, names=[name for name,mesh in meshes])
+        # a file that is cut short by a failure is removed
+        if levels is None:
+            writeOutput = lambda meshes : saveOrRemove(save, outfile, meshes)
+        else:
+            # the meshes come path by path, each with all its levels, and each level has its own writer
+            base,ext = os.path.splitext(outfile)
+            writeOutput = [ (lambda meshes, filename=base + "_lod" + str(level) + ext : saveOrRemove(save, filename, meshes)) for level in levels ]
     else:
-        scad = ""
-        for i,(name,mesh) in enumerate(data.meshes):
-            mesh,centerX,centerY,width,height = recenterMesh(mesh)
-            data.meshes[i] = (name,mesh)
-            scad += "center_%s = [%s,%s];\n" % (name,decimal(centerX),decimal(centerY))
-            scad += "size_%s = [%s,%s];\n" % (name,decimal(width),decimal(height))
-            scad += "color_%s = %s;\n\n" % (name,describeColor(getColorFromMesh(mesh)))
+        def writeOutput(meshes):
+            saveInflatedSCAD(outfile, meshes, levels=levels, importSTL=importSTL)
             
-        for name,mesh in data.meshes:
-            scad += toSCADModule(mesh, moduleName=name, digitsAfterDecimal=5, colorOverride="")
-            scad += "\n"
-        
-        for name,_ in data.meshes:
-            scad += "translate(center_%s) color(color_%s) %s();\n" % (name,name,name)
+    if isinstance(writeOutput, list):
+        consumeAlternatelyInBackground(writeOutput, meshes)
+    else:
+        consumeInBackground(writeOutput, meshes)
             
-        if outfile:
-            with open(outfile, "w") as f: f.write(scad)
-        else:
-            print(scad)    
+    if traceFile:
+        trace.close()    
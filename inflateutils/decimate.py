@@ -0,0 +1,156 @@
+from __future__ import division
+import heapq
+import math
+from array import array
+from .indexedmesh import IndexedMesh
+
+def _faceQuadric(p0, p1, p2):
+    # quadric of the plane through three points, as the upper triangle of the 4x4 matrix
+    ux,uy,uz = p1[0]-p0[0], p1[1]-p0[1], p1[2]-p0[2]
+    vx,vy,vz = p2[0]-p0[0], p2[1]-p0[1], p2[2]-p0[2]
+    a = uy*vz - uz*vy
+    b = uz*vx - ux*vz
+    c = ux*vy - uy*vx
+    n = math.sqrt(a*a + b*b + c*c)
+    if n == 0.:
+        return None
+    a /= n
+    b /= n
+    c /= n
+    d = -(a*p0[0] + b*p0[1] + c*p0[2])
+    return [a*a, a*b, a*c, a*d, b*b, b*c, b*d, c*c, c*d, d*d]
+
+def _quadricError(q, p):
+    x,y,z = p
+    return max(0., q[0]*x*x + 2*q[1]*x*y + 2*q[2]*x*z + 2*q[3]*x + q[4]*y*y + 2*q[5]*y*z + 2*q[6]*y +
+                q[7]*z*z + 2*q[8]*z + q[9])
+
+def _normal(p0, p1, p2):
+    ux,uy,uz = p1[0]-p0[0], p1[1]-p0[1], p1[2]-p0[2]
+    vx,vy,vz = p2[0]-p0[0], p2[1]-p0[1], p2[2]-p0[2]
+    return (uy*vz - uz*vy, uz*vx - ux*vz, ux*vy - uy*vx)
+
+def decimateMesh(mesh, targetFaces=None, maxError=None):
+    """
+    Simplifies an IndexedMesh by edge collapses in order of quadric error (Garland and Heckbert).
+
+    targetFaces: stop once there are no more than this many faces
+    maxError: never move the surface further than this from the planes of the original faces it
+              was made from (the square root of the quadric error bounds that distance)
+
+    Vertices at z=0 (the outline and the base plane) and on open edges never move, and collapses
+    that would flip a face or make the mesh non-manifold are skipped.
+
+    Returns a new IndexedMesh.
+    """
+    if targetFaces is None and maxError is None:
+        return mesh.copy()
+
+    n = mesh.numVertices()
+    v = mesh.vertices
+    points = [ (v[3*i],v[3*i+1],v[3*i+2]) for i in range(n) ]
+    faces = [ list(face) for face in mesh.getFaces() ]
+    alive = [True] * len(faces)
+    numFaces = len(faces)
+    vertexFaces = [ set() for i in range(n) ]
+    quadrics = [ [0.]*10 for i in range(n) ]
+    edgeCount = {}
+
+    for f,face in enumerate(faces):
+        q = _faceQuadric(*(points[i] for i in face))
+        for k in range(3):
+            vertexFaces[face[k]].add(f)
+            if q is not None:
+                quadrics[face[k]] = [a+b for a,b in zip(quadrics[face[k]], q)]
+            edge = (min(face[k],face[k-1]), max(face[k],face[k-1]))
+            edgeCount[edge] = edgeCount.get(edge, 0) + 1
+
+    locked = [ p[2] == 0. for p in points ]
+    for (a,b),count in edgeCount.items():
+        if count != 2:
+            locked[a] = True
+            locked[b] = True
+
+    maxCost = float("inf") if maxError is None else maxError * maxError
+    version = [0] * n
+    heap = []
+
+    def neighbors(i):
+        return set(j for f in vertexFaces[i] for j in faces[f] if j != i)
+
+    def plan(a, b):
+        # returns (cost, survivor, removed, position) for collapsing edge ab, or None
+        if locked[a] and locked[b]:
+            return None
+        q = [x+y for x,y in zip(quadrics[a], quadrics[b])]
+        if locked[a]:
+            return _quadricError(q, points[a]), a, b, points[a]
+        elif locked[b]:
+            return _quadricError(q, points[b]), b, a, points[b]
+        mid = tuple(0.5*(x+y) for x,y in zip(points[a], points[b]))
+        return min( (_quadricError(q, p), a, b, p) for p in (points[a], points[b], mid) )
+
+    def push(a, b):
+        c = plan(a, b)
+        if c is not None and c[0] <= maxCost:
+            heapq.heappush(heap, (c[0], a, b, version[a], version[b]))
+
+    for a,b in edgeCount:
+        push(a, b)
+
+    def valid(keep, remove, position):
+        shared = [f for f in vertexFaces[remove] if keep in faces[f]]
+        if len(shared) != 2:
+            return False
+        opposite = set(j for f in shared for j in faces[f] if j != keep and j != remove)
+        if neighbors(keep) & neighbors(remove) != opposite:
+            return False
+        for i in (keep, remove):
+            for f in vertexFaces[i]:
+                if f in shared:
+                    continue
+                face = faces[f]
+                before = [points[j] for j in face]
+                after = [position if j == keep or j == remove else points[j] for j in face]
+                n0 = _normal(*before)
+                n1 = _normal(*after)
+                if n0[0]*n1[0] + n0[1]*n1[1] + n0[2]*n1[2] <= 0.:
+                    return False
+        return True
+
+    while heap and (targetFaces is None or numFaces > targetFaces):
+        cost,a,b,va,vb = heapq.heappop(heap)
+        if va != version[a] or vb != version[b]:
+            continue
+        c = plan(a, b)
+        if c is None or c[0] > maxCost:
+            continue
+        cost,keep,remove,position = c
+        if not valid(keep, remove, position):
+            continue
+        for f in list(vertexFaces[remove]):
+            face = faces[f]
+            if keep in face:
+                alive[f] = False
+                numFaces -= 1
+                for j in face:
+                    if j != remove:
+                        vertexFaces[j].discard(f)
+            else:
+                face[face.index(remove)] = keep
+                vertexFaces[keep].add(f)
+        vertexFaces[remove] = set()
+        points[keep] = position
+        quadrics[keep] = [x+y for x,y in zip(quadrics[keep], quadrics[remove])]
+        version[keep] += 1
+        version[remove] += 1
+        for j in neighbors(keep):
+            push(keep, j)
+
+    out = IndexedMesh(color=mesh.color)
+    out.vertices = array('d', (x for p in points for x in p))
+    for f,face in enumerate(faces):
+        if alive[f]:
+            out.addFace(*face)
+    out.compact()
+    return out
@@ -1,25 +1,52 @@
-from struct import pack
+from struct import pack, Struct
+from array import array
 from .vector import *
-from .formatdecimal import decimal
+from .indexedmesh import *
+from .formatdecimal import decimal, decimalList
 from numbers import Number 
+import math
 import os
 import sys
+import threading
+import json
+import zipfile
+from xml.sax.saxutils import quoteattr
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 try:
     basestring
 except:
     basestring = str
 
+STL_RECORD = Struct("<12fH")
+
 def isColorTriangleList(polys):
     return isinstance(polys[0][1][0][0], Number)
     
 def toPolyhedra(polys):
+    if isIndexedMesh(polys):
+        polys = [polys]
+    if len(polys) and isIndexedMesh(polys[0]):
+        return [ (mesh.color, list(mesh.getTriangles())) for mesh in polys ]
     if isColorTriangleList(polys):
         return [ (polys[0][0], list(face for rgb,face in polys)) ]
     else:
         return polys
         
 def toMesh(polys):
+    if isIndexedMesh(polys):
+        polys = [polys]
+    if len(polys) and isIndexedMesh(polys[0]):
+        return [ datum for mesh in polys for datum in mesh.toColorTriangleList() ]
     if isColorTriangleList(polys):
         return polys
     else:
@@ -28,6 +55,27 @@ def toMesh(polys):
             for face in polyhedron:
                 output.append((rgb,face))
         return output
+        
+def toIndexedMeshes(polys):
+    """
+    Converts an IndexedMesh, a list of IndexedMeshes, a list of (color,triangle) pairs or a list of
+    (color,polyhedron) pairs to a list of IndexedMeshes, one per color run.
+    """
+    if isIndexedMesh(polys):
+        return [polys]
+    polys = list(polys)
+    if not len(polys):
+        return []
+    if isIndexedMesh(polys[0]):
+        return polys
+    if isColorTriangleList(polys):
+        groups = []
+        for rgb,triangle in polys:
+            if not groups or groups[-1][0] != rgb:
+                groups.append((rgb,[]))
+            groups[-1][1].append(triangle)
+        polys = groups
+    return [ indexedMeshFromTriangles(polyhedron, color=rgb) for rgb,polyhedron in polys ]
 
 def describeColor(c):
     if c is None:
@@ -37,91 +85,608 @@ def describeColor(c):
     else:
         return "[%s,%s,%s]" % tuple(decimal(component) for component in c)
 
+# vertices or faces formatted per chunk of streamed text output
+CHUNK_SIZE = 4096
+
 def toSCADModule(polys, moduleName, digitsAfterDecimal=9, colorOverride=None):
     """
     INPUT:
-    polys: list of (color,polyhedra) pairs (counterclockwise triangles), or a list of (color,triangle) pairs (TODO: currently uses first color for all in latter case)
+    polys: IndexedMesh or list of IndexedMeshes, or list of (color,polyhedra) pairs (counterclockwise triangles), 
+           or a list of (color,triangle) pairs
     moduleName: OpenSCAD module name
     
     OUTPUT: string with OpenSCAD code implementing the polys
     """
+    return "".join(generateSCADModule(polys, moduleName, digitsAfterDecimal=digitsAfterDecimal, colorOverride=colorOverride))
     
-    polys = toPolyhedra(polys)
+def generateSCADModule(polys, moduleName, digitsAfterDecimal=9, colorOverride=None):
+    """
+    Like toSCADModule(), but yields the code in chunks of at most CHUNK_SIZE points or faces, so
+    that it can be written out without ever holding all of it. The points are the mesh's own
+    vertex list, used by index, so nothing is deduplicated or looked up.
+    """
+    
+    meshes = toIndexedMeshes(polys)
     
-    scad = []
-    scad.append("module " +moduleName+ "() {")
-    for rgb,poly in polys:
+    yield "module " +moduleName+ "() {"
+    for mesh in meshes:
+        rgb = mesh.color
         if colorOverride != "" and (colorOverride or rgb):
-            line = "  color(%s) " % describeColor(colorOverride if colorOverride else tuple(min(max(c,0.),1.0) for c in rgb))
+            yield "\n  color(%s) " % describeColor(colorOverride if colorOverride else tuple(min(max(c,0.),1.0) for c in rgb))
         else:
-            line = "  "
-        pointsDict = {}
-        i = 0
-        line += "polyhedron(points=["
-        points = []
-        for face in poly:
-            for v in reversed(face):
-                if tuple(v) not in pointsDict:
-                    pointsDict[tuple(v)] = i
-                    points.append( ("[%s,%s,%s]") % tuple(decimal(x,digitsAfterDecimal) for x in v) )
-                    i += 1
-        line += ",".join(points)
-        line += "], faces=["
-        line += ",".join( "[" + ",".join(str(pointsDict[tuple(v)]) for v in reversed(face)) + "]" for face in poly ) + "]"
-        line += ");"
-        scad.append(line)
-    scad.append("}\n")
-    return "\n".join(scad)
+            yield "\n  "
+        yield "polyhedron(points=["
+        v = mesh.vertices
+        for i in range(0, len(v), 3*CHUNK_SIZE):
+            coords = decimalList(v[i:i+3*CHUNK_SIZE], digitsAfterDecimal)
+            chunk = "[%s,%s,%s]," * (len(coords) // 3) % tuple(coords)
+            yield chunk if i + 3*CHUNK_SIZE < len(v) else chunk[:-1]
+        yield "], faces=["
+        f = mesh.faces
+        for i in range(0, len(f), 3*CHUNK_SIZE):
+            # reversed, since OpenSCAD wants clockwise faces
+            faces = f[i:i+3*CHUNK_SIZE]
+            reversedFaces = list(faces)
+            reversedFaces[0::3] = faces[2::3]
+            reversedFaces[2::3] = faces[0::3]
+            chunk = "[%d,%d,%d]," * (len(faces) // 3) % tuple(reversedFaces)
+            yield chunk if i + 3*CHUNK_SIZE < len(f) else chunk[:-1]
+        yield "]);"
+    yield "\n}\n"
 
 def saveSCAD(filename, polys, moduleName="object1", quiet=False):
     """
     filename: filename to write OpenSCAD file
-    polys: list of (color,polyhedra) pairs (counterclockwise triangles)
+    polys: IndexedMesh or list of IndexedMeshes, or list of (color,polyhedra) pairs (counterclockwise triangles)
     moduleName: OpenSCAD module name
     quiet: give no status message if set
     """
     if not quiet: sys.stderr.write("Saving %s\n" % filename)
+    def write(f):
+        for chunk in generateSCADModule(polys, moduleName):
+            f.write(chunk)
+        f.write("\n" + moduleName + "();\n")
     if filename:
         with open(filename, "w") as f:
-            f.write(toSCADModule(polys, moduleName))
-            f.write("\n" + moduleName + "();\n")
+            write(f)
     else:
-        sys.stdout.write(toSCADModule(polys, moduleName))
-        sys.stdout.write("\n" + moduleName + "();\n")
+        write(sys.stdout)
+
+def _vertexColors(meshes, colors):
+    # returns a (r,g,b) byte triple per mesh, or None if there are to be no vertex colors
+    if colors is None:
+        colors = any(mesh.color is not None and not isinstance(mesh.color, basestring) for mesh in meshes)
+    if not colors:
+        return None
+    return [ (255,255,255) if mesh.color is None or isinstance(mesh.color, basestring) else
+             tuple(min(255,max(0,int(0.5 + 255 * comp))) for comp in mesh.color) for mesh in meshes ]
 
-def saveSTL(filename, mesh, swapYZ=False, quiet=False):
+def _littleEndian(data):
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tostring() if sys.version_info[0] < 3 else data.tobytes()
+
+def _interleave(records, recordSize, start, data, size):
+    # copies consecutive size-byte items of data into each recordSize-byte record of records at start
+    for i in range(size):
+        records[start+i::recordSize] = data[i::size]
+
+def savePLY(filename, polys, quiet=False, colors=None):
     """
-    filename: filename to save STL file
-    mesh: list of (color,triangle) pairs (counterclockwise)
-    swapYZ: should Y/Z axes be swapped?
+    filename: filename to save binary little-endian PLY file
+    polys: IndexedMesh or list of IndexedMeshes, or list of (color,polyhedra) pairs (counterclockwise triangles), 
+           or a list of (color,triangle) pairs
     quiet: give no status message if set
+    colors: whether to give each vertex the red, green and blue of its mesh; by default, if any mesh has a color
+    
+    The meshes are combined into one vertex list and one face list.
+    """
+    meshes = toIndexedMeshes(polys)
+    rgbs = _vertexColors(meshes, colors)
+    if not quiet: sys.stderr.write("Saving %s\n" % filename)
+    numVertices = sum(mesh.numVertices() for mesh in meshes)
+    numFaces = sum(mesh.numFaces() for mesh in meshes)
+    header = [ "ply", "format binary_little_endian 1.0", "element vertex %d" % numVertices,
+        "property float x", "property float y", "property float z" ]
+    if rgbs is not None:
+        header += [ "property uchar red", "property uchar green", "property uchar blue" ]
+    header += [ "element face %d" % numFaces, "property list uchar int vertex_indices", "end_header" ]
+    
+    def writePLY(write):
+        write(("\n".join(header) + "\n").encode("ascii"))
+        for k,mesh in enumerate(meshes):
+            coords = _littleEndian(array('f', mesh.vertices))
+            if rgbs is None:
+                write(coords)
+            else:
+                n = mesh.numVertices()
+                records = bytearray(15 * n)
+                _interleave(records, 15, 0, coords, 12)
+                for i in range(3):
+                    records[12+i::15] = bytearray((rgbs[k][i],)) * n
+                write(records)
+        offset = 0
+        for mesh in meshes:
+            n = mesh.numFaces()
+            if offset:
+                indices = array('i', (i + offset for i in mesh.faces))
+            else:
+                indices = array('i', mesh.faces)
+            records = bytearray(13 * n)
+            records[0::13] = bytearray((3,)) * n
+            _interleave(records, 13, 1, _littleEndian(indices), 12)
+            write(records)
+            offset += mesh.numVertices()
+        
+    if filename:
+        with open(filename, "wb") as f:
+            writePLY(f.write)
+    else:
+        stdout = getattr(sys.stdout, "buffer", sys.stdout)
+        writePLY(stdout.write)
+        stdout.flush()
+
+def saveOBJ(filename, polys, quiet=False, colors=None, names=None, digitsAfterDecimal=6):
+    """
+    filename: filename to save Wavefront OBJ file
+    polys: IndexedMesh or list of IndexedMeshes, or list of (color,polyhedra) pairs (counterclockwise triangles), 
+           or a list of (color,triangle) pairs
+    quiet: give no status message if set
+    colors: whether to append the red, green and blue of its mesh (from 0 to 1) to each vertex line, as 
+            many programs accept; by default, if any mesh has a color
+    names: if not None, a list of object names for the meshes
+    
+    Each mesh is written as its own object, with the vertex numbers continuing across them.
+    """
+    meshes = toIndexedMeshes(polys)
+    rgbs = _vertexColors(meshes, colors)
+    if not quiet: sys.stderr.write("Saving %s\n" % filename)
+    
+    def writeOBJ(write):
+        offset = 1
+        for k,mesh in enumerate(meshes):
+            write("o %s\n" % (names[k] if names else "object%d" % (k+1)))
+            if rgbs is None:
+                vertexFormat = "v %s %s %s\n"
+            else:
+                vertexFormat = "v %%s %%s %%s %s\n" % " ".join(decimal(c / 255.) for c in rgbs[k])
+            v = mesh.vertices
+            for i in range(0, len(v), 3*CHUNK_SIZE):
+                coords = decimalList(v[i:i+3*CHUNK_SIZE], digitsAfterDecimal)
+                write(vertexFormat * (len(coords) // 3) % tuple(coords))
+            f = mesh.faces
+            for i in range(0, len(f), 3*CHUNK_SIZE):
+                indices = tuple(j + offset for j in f[i:i+3*CHUNK_SIZE])
+                write("f %d %d %d\n" * (len(indices) // 3) % indices)
+            offset += mesh.numVertices()
+            
+    if filename:
+        with open(filename, "w") as f:
+            writeOBJ(f.write)
+    else:
+        writeOBJ(sys.stdout.write)
+
+def _srgbToLinear(c):
+    return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+def getVertexNormals(mesh):
+    """
+    Returns a flat array('d') with a unit normal per vertex: the area-weighted average of the
+    normals of the faces around it.
+    """
+    v = mesh.vertices
+    normals = array('d', [0.]) * len(v)
+    f = mesh.faces
+    for k in range(0,len(f),3):
+        a,b,c = 3*f[k],3*f[k+1],3*f[k+2]
+        ux,uy,uz = v[b]-v[a],v[b+1]-v[a+1],v[b+2]-v[a+2]
+        wx,wy,wz = v[c]-v[a],v[c+1]-v[a+1],v[c+2]-v[a+2]
+        nx,ny,nz = uy*wz-uz*wy, uz*wx-ux*wz, ux*wy-uy*wx
+        for i in (a,b,c):
+            normals[i] += nx
+            normals[i+1] += ny
+            normals[i+2] += nz
+    for i in range(0,len(normals),3):
+        n = math.sqrt(normals[i]*normals[i] + normals[i+1]*normals[i+1] + normals[i+2]*normals[i+2])
+        if n:
+            normals[i] /= n
+            normals[i+1] /= n
+            normals[i+2] /= n
+    return normals
+
+def saveGLB(filename, meshes, quiet=False):
+    """
+    filename: filename to save binary glTF file (or None for stdout)
+    meshes: IndexedMesh or list of IndexedMeshes, or list or iterator of (name,IndexedMesh) pairs
+    quiet: give no status message if set
+    
+    Each mesh becomes a node with one primitive with float32 positions and smoothed normals,
+    uint32 indices and a material with the mesh's color. The nodes are under a root node that 
+    turns millimeters with z up into glTF's meters with y up.
+    """
+    if not quiet: sys.stderr.write("Saving %s\n" % filename)
+    if isIndexedMesh(meshes):
+        meshes = [meshes]
+    chunks = []
+    length = 0
+    gltf = { "asset" : { "version" : "2.0", "generator" : "inflatemesh" },
+             "scene" : 0, "scenes" : [ { "nodes" : [0] } ],
+             "nodes" : [ { "children" : [], "rotation" : [-math.sqrt(0.5), 0., 0., math.sqrt(0.5)], "scale" : [0.001, 0.001, 0.001] } ],
+             "meshes" : [], "materials" : [], "accessors" : [], "bufferViews" : [] }
+    
+    def addView(data, target, count, componentType, type, bounds=None):
+        # data is 4-byte aligned, so the views need no padding
+        gltf["bufferViews"].append( { "buffer" : 0, "byteOffset" : length, "byteLength" : len(data), "target" : target } )
+        accessor = { "bufferView" : len(gltf["bufferViews"])-1, "componentType" : componentType, "count" : count, "type" : type }
+        if bounds is not None:
+            accessor["min"] = list(bounds[0])
+            accessor["max"] = list(bounds[1])
+        gltf["accessors"].append(accessor)
+        chunks.append(data)
+        return len(gltf["accessors"])-1, length + len(data)
+    
+    for i,mesh in enumerate(meshes):
+        if isIndexedMesh(mesh):
+            name = "object%d" % (i+1)
+        else:
+            name,mesh = mesh
+        if not mesh.numFaces():
+            continue
+        rgb = mesh.color
+        if rgb is None or isinstance(rgb, basestring):
+            rgb = (1.,1.,1.)
+        positions = array('f', mesh.vertices)
+        lower,upper = mesh.getBounds()
+        # the bounds must be those of the float32 values
+        bounds = ( [array('f', [x])[0] for x in lower], [array('f', [x])[0] for x in upper] )
+        position,length = addView(_littleEndian(positions), 34962, mesh.numVertices(), 5126, "VEC3", bounds)
+        normal,length = addView(_littleEndian(array('f', getVertexNormals(mesh))), 34962, mesh.numVertices(), 5126, "VEC3")
+        indices,length = addView(_littleEndian(array('i', mesh.faces)), 34963, len(mesh.faces), 5125, "SCALAR")
+        gltf["materials"].append( { "name" : name, "pbrMetallicRoughness" : { 
+                "baseColorFactor" : [_srgbToLinear(min(max(c,0.),1.)) for c in rgb] + [1.], "metallicFactor" : 0., "roughnessFactor" : 1. } } )
+        gltf["meshes"].append( { "name" : name, "primitives" : [ { "attributes" : { "POSITION" : position, "NORMAL" : normal },
+                "indices" : indices, "material" : len(gltf["materials"])-1 } ] } )
+        gltf["nodes"].append( { "name" : name, "mesh" : len(gltf["meshes"])-1 } )
+        gltf["nodes"][0]["children"].append(len(gltf["nodes"])-1)
+    
+    gltf["buffers"] = [ { "byteLength" : length } ]
+    if not gltf["nodes"][0]["children"]:
+        del gltf["nodes"][0]["children"]
+    for key in ("meshes", "materials", "accessors", "bufferViews"):
+        if not gltf[key]:
+            del gltf[key]
+    header = json.dumps(gltf, separators=(",",":")).encode("utf-8")
+    header += b" " * (-len(header) % 4)
+    
+    def writeGLB(write):
+        write(pack("<4sII", b"glTF", 2, 12 + 8 + len(header) + 8 + length))
+        write(pack("<I4s", len(header), b"JSON"))
+        write(header)
+        write(pack("<I4s", length, b"BIN\0"))
+        for chunk in chunks:
+            write(chunk)
+            
+    if filename:
+        with open(filename, "wb") as f:
+            writeGLB(f.write)
+    else:
+        stdout = getattr(sys.stdout, "buffer", sys.stdout)
+        writeGLB(stdout.write)
+        stdout.flush()
+
+THREEMF_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+ <Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+ <Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>
+</Types>
+"""
+
+THREEMF_RELS = """<?xml version="1.0" encoding="UTF-8"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+ <Relationship Target="/3D/3dmodel.model" Id="rel0" Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>
+</Relationships>
+"""
+
+def generate3MFModel(meshes, digitsAfterDecimal=6):
     """
+    Yields the 3D/3dmodel.model XML of a 3MF file in chunks of at most CHUNK_SIZE vertices or triangles.
     
-    mesh = toMesh(mesh)
+    meshes: iterable of (name,IndexedMesh) pairs, each of which becomes one object, colored
+            with its own base material if its color is an (r,g,b) tuple
+    """
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<model unit="millimeter" xml:lang="en-US" xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">\n'
+           '<resources>\n')
+    objects = []
+    nextId = 1
+    for name,mesh in meshes:
+        rgb = mesh.color
+        if rgb is not None and not isinstance(rgb, basestring):
+            rgb = tuple(min(255,max(0,int(0.5 + 255 * comp))) for comp in rgb)
+            yield '<basematerials id="%d"><base name=%s displaycolor="#%02X%02X%02X"/></basematerials>\n' % ((nextId,quoteattr(name))+rgb)
+            material = ' pid="%d" pindex="0"' % nextId
+            nextId += 1
+        else:
+            material = ''
+        yield '<object id="%d" type="model" name=%s%s>\n<mesh>\n<vertices>\n' % (nextId, quoteattr(name), material)
+        objects.append(nextId)
+        nextId += 1
+        v = mesh.vertices
+        for i in range(0, len(v), 3*CHUNK_SIZE):
+            coords = decimalList(v[i:i+3*CHUNK_SIZE], digitsAfterDecimal)
+            yield '<vertex x="%s" y="%s" z="%s"/>\n' * (len(coords) // 3) % tuple(coords)
+        yield '</vertices>\n<triangles>\n'
+        f = mesh.faces
+        for i in range(0, len(f), 3*CHUNK_SIZE):
+            faces = f[i:i+3*CHUNK_SIZE]
+            yield '<triangle v1="%d" v2="%d" v3="%d"/>\n' * (len(faces) // 3) % tuple(faces)
+        yield '</triangles>\n</mesh>\n</object>\n'
+    yield '</resources>\n<build>\n'
+    for objectId in objects:
+        yield '<item objectid="%d"/>\n' % objectId
+    yield '</build>\n</model>\n'
+
+def save3MF(filename, meshes, quiet=False):
+    """
+    filename: filename to save 3MF file (or None for stdout)
+    meshes: IndexedMesh or list of IndexedMeshes, or list or iterator of (name,IndexedMesh) pairs
+    quiet: give no status message if set
     
+    The meshes are written as they arrive, with the XML compressed in chunks.
+    """
     if not quiet: sys.stderr.write("Saving %s\n" % filename)
-    minY = float("inf")
-    minVector = Vector(float("inf"),float("inf"),float("inf"))
-    numTriangles = 0
+    if isIndexedMesh(meshes):
+        meshes = [meshes]
+    def named(meshes):
+        for i,mesh in enumerate(meshes):
+            if isIndexedMesh(mesh):
+                yield "object%d" % (i+1), mesh
+            else:
+                yield mesh
+    if filename:
+        out = open(filename, "wb")
+    else:
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+    try:
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("[Content_Types].xml", THREEMF_CONTENT_TYPES)
+            z.writestr("_rels/.rels", THREEMF_RELS)
+            chunks = generate3MFModel(named(meshes))
+            if hasattr(z, "open") and sys.version_info >= (3,6):
+                with z.open("3D/3dmodel.model", "w") as f:
+                    for chunk in chunks:
+                        f.write(chunk.encode("utf-8"))
+            else:
+                z.writestr("3D/3dmodel.model", "".join(chunks).encode("utf-8"))
+    finally:
+        if filename:
+            out.close()
+        else:
+            out.flush()
+
+class OutputWriter(object):
+    """
+    Buffered text output to filename, or to stdout if filename is None, for writing a file piece
+    by piece instead of building it up as one string. Use in a with statement, or call close().
+    """
+    def __init__(self, filename=None, bufferSize=65536):
+        self.filename = filename
+        self.file = open(filename, "w") if filename else sys.stdout
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.size = 0
+        
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.bufferSize:
+            self.flush()
+            
+    def flush(self):
+        if self.buffer:
+            self.file.write("".join(self.buffer))
+            self.buffer = []
+            self.size = 0
+        self.file.flush()
+        
+    def close(self):
+        self.flush()
+        if self.filename:
+            self.file.close()
+            
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, traceback):
+        self.close()
+        if type is not None and self.filename:
+            # leave no truncated file behind
+            os.remove(self.filename)
+            
+def saveOrRemove(save, filename, *args, **kwargs):
+    """
+    Returns save(filename, ...), removing the file if that fails partway through so that no truncated
+    file is left behind.
+    """
+    try:
+        return save(filename, *args, **kwargs)
+    except BaseException:
+        if filename and os.path.exists(filename):
+            os.remove(filename)
+        raise
+        
+class ProducerError(Exception):
+    """
+    Raised in a consumer of consumeInBackground() when the items stop because their producer failed.
+    """
+    pass
+
+def consumeInBackground(consumer, items, maxQueue=1):
+    """
+    Iterates over items on this thread while consumer(iterator) runs on a background thread and
+    receives them through a queue holding at most maxQueue of them, so that making the next item
+    overlaps with consuming the last one. Returns what consumer returns, and re-raises exceptions
+    from either side. If making the items fails, the consumer gets a ProducerError from its iterator
+    in place of the next item, so that it can clean up instead of finishing with what it has.
+    """
+    return consumeAlternatelyInBackground([consumer], items, maxQueue=maxQueue)[0]
+    
+def consumeAlternatelyInBackground(consumers, items, maxQueue=1):
+    """
+    Like consumeInBackground(), but with each of consumers on its own background thread with its own
+    queue, the i-th item going to consumers[i % len(consumers)]. Returns the list of what the 
+    consumers return.
+    """
+    items = iter(items)
+    end = object()
+    failed = object()
+    channels = [ queue.Queue(maxQueue) for consumer in consumers ]
+    states = [ {} for consumer in consumers ]
+    
+    def received(channel, state):
+        while True:
+            item = channel.get()
+            if item is end or item is failed:
+                state["ended"] = True
+                if item is failed:
+                    raise ProducerError()
+                return
+            yield item
+            
+    def run(consumer, channel, state):
+        try:
+            state["result"] = consumer(received(channel, state))
+        except BaseException as e:
+            state["error"] = e
+        finally:
+            # keep taking items so that the producer never blocks on a consumer that has stopped
+            while not state.get("ended"):
+                if channel.get() in (end, failed):
+                    state["ended"] = True
+                    
+    threads = [ threading.Thread(target=run, args=args) for args in zip(consumers, channels, states) ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    finished = False
+    try:
+        for i,item in enumerate(items):
+            if any("error" in state for state in states):
+                break
+            channels[i % len(channels)].put(item)
+        finished = True
+    finally:
+        for channel in channels:
+            channel.put(end if finished else failed)
+        for thread in threads:
+            thread.join()
+    for state in states:
+        if "error" in state:
+            raise state["error"]
+    return [ state.get("result") for state in states ]
+
+def _stlRecords(mesh, minVector, swapYZ, color):
+    """
+    Returns the 50-byte binary STL records of the faces of an IndexedMesh in one buffer.
+    """
+    if numpy is not None:
+        return _stlRecordsNumPy(mesh, minVector, swapYZ, color)
+        
+    v = mesh.vertices
+    mx,my,mz = minVector
+    if swapYZ:
+        points = [ (v[i]-mx, -v[i+2]-my, v[i+1]-mz) for i in range(0,len(v),3) ]
+    else:
+        points = [ (v[i]-mx, v[i+1]-my, v[i+2]-mz) for i in range(0,len(v),3) ]
+    f = mesh.faces
+    records = bytearray(50 * mesh.numFaces())
+    packInto = STL_RECORD.pack_into
+    offset = 0
+    for k in range(0,len(f),3):
+        a,b,c = 3*f[k],3*f[k+1],3*f[k+2]
+        ux,uy,uz = v[b]-v[a],v[b+1]-v[a+1],v[b+2]-v[a+2]
+        wx,wy,wz = v[c]-v[a],v[c+1]-v[a+1],v[c+2]-v[a+2]
+        nx,ny,nz = uy*wz-uz*wy, uz*wx-ux*wz, ux*wy-uy*wx
+        n = math.sqrt(nx*nx+ny*ny+nz*nz)
+        if n:
+            nx,ny,nz = nx/n,ny/n,nz/n
+        if swapYZ:
+            ny,nz = -nz,ny
+        p0,p1,p2 = points[f[k]],points[f[k+1]],points[f[k+2]]
+        packInto(records, offset, nx,ny,nz, p0[0],p0[1],p0[2], p1[0],p1[1],p1[2], p2[0],p2[1],p2[2], color)
+        offset += 50
+    return records
+    
+def _stlRecordsNumPy(mesh, minVector, swapYZ, color):
+    vertices = numpy.frombuffer(mesh.vertices, dtype=numpy.float64).reshape(-1,3)
+    faces = numpy.frombuffer(mesh.faces, dtype=numpy.intc).reshape(-1,3)
+    triangles = vertices[faces]
+    normals = numpy.cross(triangles[:,1]-triangles[:,0], triangles[:,2]-triangles[:,0])
+    lengths = numpy.sqrt((normals*normals).sum(axis=1))
+    lengths[lengths == 0.] = 1.
+    normals /= lengths[:,None]
     if swapYZ:
-        matrix = Matrix( (1,0,0), (0,0,-1), (0,1,0) )
+        flip = numpy.array((1.,-1.,1.))
+        triangles = triangles[:,:,(0,2,1)] * flip
+        normals = normals[:,(0,2,1)] * flip
+    records = numpy.zeros(len(faces), dtype=[("normal","<f4",(3,)), ("vertices","<f4",(3,3)), ("color","<u2")])
+    records["normal"] = normals
+    records["vertices"] = triangles - numpy.array(tuple(minVector))
+    records["color"] = color
+    return records.tobytes()
+
+def saveSTL(filename, mesh, swapYZ=False, quiet=False, bounds=None, mono=None, positive=True):
+    """
+    filename: filename to save STL file
+    mesh: IndexedMesh or list of IndexedMeshes, or list of (color,triangle) pairs (counterclockwise)
+    swapYZ: should Y/Z axes be swapped?
+    quiet: give no status message if set
+    bounds: if not None, (minVector,maxVector) containing all the vertices (before swapping axes)
+    mono: if not None, says whether to leave out the colors
+    positive: shift the coordinates so that they are all positive
+    
+    If both bounds and mono are given, mesh can also be an iterator over IndexedMeshes, and when 
+    writing to a file each mesh is written as soon as it is made. Otherwise all the meshes are 
+    gathered first so that the bounds, colors and triangle count can be found.
+    
+    Each mesh is packed into one buffer (with NumPy if it is installed) and written at once.
+    """
+    
+    if not quiet: sys.stderr.write("Saving %s\n" % filename)
+        
+    if bounds is None or mono is None or not filename:
+        meshes = toIndexedMeshes(mesh)
+    elif isIndexedMesh(mesh):
+        meshes = [mesh]
     else:
-        matrix = Matrix.identity(3)
+        meshes = mesh
+        
+    if mono is None:
+        mono = all(mesh.color is None for mesh in meshes)
         
-    mono = True
-    for rgb,triangle in mesh:
-        if rgb is not None:
-            mono = False
-        numTriangles += 1
-        for vertex in triangle:
-            vertex = matrix*vertex
-            minVector = Vector(min(minVector[i], vertex[i]) for i in range(3))
-    minVector -= Vector(0.001,0.001,0.001) # make sure all STL coordinates are strictly positive as per Wikipedia
-    
-    def writeSTL(write):
+    if not positive:
+        minVector = Vector(0.,0.,0.)
+    else:
+        if bounds is None:
+            meshBounds = [ mesh.getBounds() for mesh in meshes if mesh.numVertices() ]
+            if meshBounds:
+                bounds = ( Vector(min(b[0][i] for b in meshBounds) for i in range(3)), 
+                           Vector(max(b[1][i] for b in meshBounds) for i in range(3)) )
+            else:
+                bounds = (Vector(0.,0.,0.), Vector(0.,0.,0.))
+        lower,upper = bounds
+        if swapYZ:
+            minVector = Vector(lower.x, -upper.z, lower.y)
+        else:
+            minVector = Vector(lower)
+        minVector -= Vector(0.001,0.001,0.001) # make sure all STL coordinates are strictly positive as per Wikipedia
+    
+    def writeSTL(write, numTriangles):
         write(pack("80s",b''))
         write(pack("<I",numTriangles))
-        for rgb,tri in mesh:
+        count = 0
+        for mesh in meshes:
+            rgb = mesh.color
             if mono:
                 color = 0
             else:
@@ -130,18 +695,23 @@ def saveSTL(filename, mesh, swapYZ=False, quiet=False):
                 else:
                     rgb = tuple(min(255,max(0,int(0.5 + 255 * comp))) for comp in rgb)
                 color = 0x8000 | ( (rgb[0] >> 3) << 10 ) | ( (rgb[1] >> 3) << 5 ) | ( (rgb[2] >> 3) << 0 )
-            normal = (Vector(tri[1])-Vector(tri[0])).cross(Vector(tri[2])-Vector(tri[0])).normalize()
-            write(pack("<3f", *(matrix*normal)))
-            for vertex in tri:
-                write(pack("<3f", *(matrix*(vertex-minVector))))
-            write(pack("<H", color))            
+            write(_stlRecords(mesh, minVector, swapYZ, color))
+            count += mesh.numFaces()
+        return count
 
     if filename:
         with open(filename, "wb") as f:
-            writeSTL(f.write)
+            if isinstance(meshes, list):
+                writeSTL(f.write, sum(mesh.numFaces() for mesh in meshes))
+            else:
+                # the triangle count is only known at the end
+                count = writeSTL(f.write, 0)
+                f.seek(80)
+                f.write(pack("<I",count))
     else:
         if sys.platform == "win32":
             import msvcrt
             msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
-        writeSTL(lambda data : os.write(sys.stdout.fileno(), data))
-            
\ No newline at end of file
+        stdout = getattr(sys.stdout, "buffer", sys.stdout)
+        writeSTL(stdout.write, sum(mesh.numFaces() for mesh in meshes))
+        stdout.flush()
@@ -10,6 +10,53 @@ def decimal(x,precision=9):
         return s[:-1]
     else:
         return s
-    
+
+def decimalList(values, precision=9):
+    """
+    Returns [decimal(x,precision) for x in values], formatting all of them with one % operation.
+    """
+    values = tuple(values)
+    if not values:
+        return []
+    strings = ((("%."+str(precision)+"f\n") * len(values)) % values).split("\n")
+    strings.pop()
+    if precision > 0:
+        # all but nan and inf have a decimal point, so only zeros after it are stripped
+        return [s.rstrip("0").rstrip(".") for s in strings]
+    else:
+        return strings
+
 if __name__ == '__main__':
-    print(decimal(4.4))
\ No newline at end of file
+    import random
+    import sys
+    import time
+
+    print(decimal(4.4))
+
+    # check decimalList() against decimal() on random values of all magnitudes and some special ones
+    random.seed(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    values = [0., -0., 1., -1., 10., 100., 0.5, -0.5, 1e-12, -1e-12, 1e20, 123456789.0, float("inf"), float("-inf"), float("nan"), 7, -3]
+    for i in range(200000):
+        kind = random.randint(0,4)
+        if kind == 0:
+            x = random.uniform(-1000,1000)
+        elif kind == 1:
+            x = random.uniform(-1,1) * 10 ** random.randint(-15,15)
+        elif kind == 2:
+            x = round(random.uniform(-1000,1000), random.randint(0,9))
+        elif kind == 3:
+            x = random.randint(-10**6,10**6) / 2 ** random.randint(0,20)
+        else:
+            x = random.randint(-1000,1000)
+        values.append(x)
+    for precision in range(13):
+        t0 = time.time()
+        slow = [decimal(x,precision) for x in values]
+        t1 = time.time()
+        fast = decimalList(values,precision)
+        t2 = time.time()
+        if slow != fast:
+            bad = [(x,a,b) for x,a,b in zip(values,slow,fast) if a != b]
+            print("precision %d: %d mismatches, e.g. %r" % (precision, len(bad), bad[:5]))
+            sys.exit(1)
+        print("precision %d: %d values match; decimal() %.3fs, decimalList() %.3fs" % (precision, len(values), t1-t0, t2-t1))
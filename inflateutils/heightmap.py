@@ -0,0 +1,88 @@
+from __future__ import division
+from struct import pack
+from array import array
+import json
+import sys
+import zlib
+
+FORMATS = ("png", "float32", "dat")
+
+def _pngChunk(kind, data):
+    return pack(">I", len(data)) + kind + data + pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+def _metadata(spacing, lowerLeft, maxHeight, heightScale):
+    return [ ("spacing", spacing), ("x0", lowerLeft.x), ("y0", lowerLeft.y), ("max_height", maxHeight),
+        ("height_scale", heightScale), ("units", "mm") ]
+
+def toPNG(heights, spacing, lowerLeft):
+    """
+    Returns a 16-bit grayscale PNG with the top row first, scaled so that 65535 is the maximum height,
+    with the scale in tEXt chunks.
+    """
+    maxHeight = max(max(row) for row in heights)
+    scale = 65535. / maxHeight if maxHeight > 0 else 0.
+    raw = bytearray()
+    for row in reversed(heights):
+        line = array('H', (min(65535, max(0, int(0.5 + z * scale))) for z in row))
+        if sys.byteorder == "little":
+            line.byteswap()
+        raw.append(0) # no filter
+        raw += line.tostring() if sys.version_info[0] < 3 else line.tobytes()
+    png = [ b"\x89PNG\r\n\x1a\n", _pngChunk(b"IHDR", pack(">IIBBBBB", len(heights[0]), len(heights), 16, 0, 0, 0, 0)) ]
+    for key,value in _metadata(spacing, lowerLeft, maxHeight, maxHeight / 65535.):
+        png.append(_pngChunk(b"tEXt", key.encode("latin-1") + b"\0" + str(value).encode("latin-1")))
+    png.append(_pngChunk(b"IDAT", zlib.compress(bytes(raw), 9)))
+    png.append(_pngChunk(b"IEND", b""))
+    return b"".join(png)
+
+def toFloat32(heights):
+    """
+    Returns the heights in millimeters as little-endian float32 values, row by row with the top row first.
+    """
+    data = array('f', (z for row in reversed(heights) for z in row))
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tostring() if sys.version_info[0] < 3 else data.tobytes()
+
+def toDAT(heights, spacing, lowerLeft, digitsAfterDecimal=5):
+    """
+    Returns the heights in millimeters in the text format of OpenSCAD's surface(), with the top row
+    first (as in an image) and the scale in comments.
+    """
+    maxHeight = max(max(row) for row in heights)
+    lines = [ "# %s: %s" % (key,value) for key,value in _metadata(spacing, lowerLeft, maxHeight, 1.) ]
+    lines.append("# use as: scale([%s,%s,1]) surface(file=...);" % (spacing,spacing))
+    format = "%." + str(digitsAfterDecimal) + "f"
+    for row in reversed(heights):
+        lines.append(" ".join(format % z for z in row))
+    return "\n".join(lines) + "\n"
+
+def saveHeightmap(filename, meshData, format="png", quiet=False):
+    """
+    filename: filename to write
+    meshData: solved MeshData
+    format: "png" (16-bit grayscale), "float32" (raw, with the scale and grid size in filename+".json")
+            or "dat" (OpenSCAD surface() text)
+    quiet: give no status message if set
+    """
+    if not quiet: sys.stderr.write("Saving %s\n" % filename)
+    spacing,lowerLeft,heights = meshData.getHeightGrid()
+    if format == "png":
+        with open(filename, "wb") as f:
+            f.write(toPNG(heights, spacing, lowerLeft))
+    elif format == "float32":
+        with open(filename, "wb") as f:
+            f.write(toFloat32(heights))
+        maxHeight = max(max(row) for row in heights)
+        metadata = dict(_metadata(spacing, lowerLeft, maxHeight, 1.))
+        metadata["width"] = len(heights[0])
+        metadata["height"] = len(heights)
+        metadata["byte_order"] = "little"
+        metadata["first_row"] = "top"
+        with open(filename + ".json", "w") as f:
+            json.dump(metadata, f, indent=1, sort_keys=True)
+    elif format == "dat":
+        with open(filename, "w") as f:
+            f.write(toDAT(heights, spacing, lowerLeft))
+    else:
+        raise ValueError("unknown heightmap format " + format)
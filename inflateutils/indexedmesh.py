@@ -0,0 +1,428 @@
+from array import array
+import math
+from .vector import *
+
+class IndexedMesh(object):
+    """
+    A triangle mesh with one color, stored as a flat array of vertex coordinates
+    (x0,y0,z0,x1,y1,z1,...) and a flat int32 array of vertex indices, three per
+    counterclockwise triangle.
+    """
+    def __init__(self, color=None):
+        self.color = color
+        self.vertices = array('d')
+        self.faces = array('i')
+
+    def addVertex(self, x, y, z):
+        self.vertices.extend((x, y, z))
+        return len(self.vertices) // 3 - 1
+
+    def addFace(self, a, b, c):
+        self.faces.extend((a, b, c))
+
+    def numVertices(self):
+        return len(self.vertices) // 3
+
+    def numFaces(self):
+        return len(self.faces) // 3
+
+    def getVertex(self, i):
+        return Vector(self.vertices[3*i:3*i+3])
+
+    def getFaces(self):
+        f = self.faces
+        for i in range(0, len(f), 3):
+            yield f[i], f[i+1], f[i+2]
+
+    def getTriangles(self):
+        for face in self.getFaces():
+            yield tuple(self.getVertex(i) for i in face)
+
+    def getBounds(self):
+        """
+        Returns (minVector, maxVector) over all the vertices.
+        """
+        v = self.vertices
+        if not len(v):
+            return None
+        return ( Vector(min(v[0::3]), min(v[1::3]), min(v[2::3])),
+                 Vector(max(v[0::3]), max(v[1::3]), max(v[2::3])) )
+
+    def copy(self):
+        mesh = IndexedMesh(color=self.color)
+        mesh.vertices = array('d', self.vertices)
+        mesh.faces = array('i', self.faces)
+        return mesh
+
+    def translate(self, delta):
+        v = self.vertices
+        for axis in range(3):
+            d = delta[axis]
+            if d:
+                v[axis::3] = array('d', (x + d for x in v[axis::3]))
+
+    def transformXY(self, rotation, translation):
+        """
+        Maps each vertex's x+iy to rotation*(x+iy)+translation, for complex rotation and translation
+        (a rotation and uniform scaling followed by a translation), leaving z alone.
+        """
+        v = self.vertices
+        a,b = rotation.real, rotation.imag
+        x = v[0::3]
+        y = v[1::3]
+        v[0::3] = array('d', (a*x0 - b*y0 + translation.real for x0,y0 in zip(x,y)))
+        v[1::3] = array('d', (b*x0 + a*y0 + translation.imag for x0,y0 in zip(x,y)))
+
+    def compact(self):
+        """
+        Drops vertices that no face uses, renumbering the rest in order.
+        """
+        n = self.numVertices()
+        used = bytearray(n)
+        for i in self.faces:
+            used[i] = 1
+        if all(used):
+            return
+        renumber = array('i', [-1]) * n
+        vertices = array('d')
+        count = 0
+        v = self.vertices
+        for i in range(n):
+            if used[i]:
+                renumber[i] = count
+                vertices.extend(v[3*i:3*i+3])
+                count += 1
+        self.vertices = vertices
+        self.faces = array('i', (renumber[i] for i in self.faces))
+
+    def weld(self, epsilon):
+        """
+        Merges each vertex into the first earlier vertex within epsilon of it along every axis, found 
+        through a spatial hash with cells of size epsilon, drops faces that become degenerate and
+        then compacts. Returns the number of vertices merged.
+        """
+        n = self.numVertices()
+        v = self.vertices
+        scale = 1. / epsilon
+        cells = {}
+        remap = array('i', range(n))
+        merged = 0
+        for i in range(n):
+            x,y,z = v[3*i],v[3*i+1],v[3*i+2]
+            cx,cy,cz = int(math.floor(x*scale)),int(math.floor(y*scale)),int(math.floor(z*scale))
+            match = -1
+            for key in ((cx+dx,cy+dy,cz+dz) for dx in (-1,0,1) for dy in (-1,0,1) for dz in (-1,0,1)):
+                for j in cells.get(key, ()):
+                    if abs(v[3*j]-x) <= epsilon and abs(v[3*j+1]-y) <= epsilon and abs(v[3*j+2]-z) <= epsilon:
+                        match = j
+                        break
+                if match >= 0:
+                    break
+            if match >= 0:
+                remap[i] = match
+                merged += 1
+            else:
+                cells.setdefault((cx,cy,cz), []).append(i)
+        if merged:
+            faces = array('i')
+            for a,b,c in self.getFaces():
+                a,b,c = remap[a],remap[b],remap[c]
+                if a != b and b != c and c != a:
+                    faces.extend((a,b,c))
+            self.faces = faces
+        self.compact()
+        return merged
+        
+    def checkManifold(self):
+        """
+        Returns (openEdges, nonManifoldEdges), lists of edges as sorted vertex index pairs: those used
+        by only one face, and those used by more than two faces or twice in the same direction. Both
+        are empty exactly when the mesh is closed, manifold along its edges and consistently oriented.
+        """
+        f = self.faces
+        count = {}
+        directed = set()
+        nonManifold = set()
+        for i in range(0, len(f), 3):
+            for a,b in ((f[i],f[i+1]), (f[i+1],f[i+2]), (f[i+2],f[i])):
+                if (a,b) in directed:
+                    nonManifold.add((min(a,b),max(a,b)))
+                directed.add((a,b))
+                edge = (min(a,b),max(a,b))
+                count[edge] = count.get(edge, 0) + 1
+        openEdges = []
+        for edge,c in count.items():
+            if c == 1:
+                openEdges.append(edge)
+            elif c > 2:
+                nonManifold.add(edge)
+        return sorted(openEdges), sorted(nonManifold)
+
+    def addMirror(self, flatten=False):
+        """
+        Closes a top surface whose boundary lies at z=0 by adding its reflection through z=0
+        (or, if flatten is set, its projection onto z=0) with reversed orientation. Vertices at
+        z=0 are shared between the two halves.
+        """
+        n = self.numVertices()
+        v = self.vertices
+        mirror = array('i', [0]) * n
+        for i in range(n):
+            z = v[3*i+2]
+            if z == 0.:
+                mirror[i] = i
+            else:
+                mirror[i] = self.addVertex(v[3*i], v[3*i+1], 0. if flatten else -z)
+        f = self.faces
+        bottom = array('i')
+        for i in range(0, len(f), 3):
+            bottom.extend((mirror[f[i+2]], mirror[f[i+1]], mirror[f[i]]))
+        self.faces.extend(bottom)
+
+    def getBoundaryLoops(self):
+        """
+        Returns the loops of edges used by only one face, each as a list of vertex indices in the 
+        direction of the faces, or None if the boundary is not a union of disjoint simple loops.
+        """
+        f = self.faces
+        edges = set()
+        for i in range(0, len(f), 3):
+            for a,b in ((f[i],f[i+1]), (f[i+1],f[i+2]), (f[i+2],f[i])):
+                if (a,b) in edges:
+                    return None
+                edges.add((a,b))
+        next = {}
+        for a,b in edges:
+            if (b,a) not in edges:
+                if a in next:
+                    return None
+                next[a] = b
+        loops = []
+        while next:
+            start,v = next.popitem()
+            loop = [start]
+            while v != start:
+                loop.append(v)
+                try:
+                    v = next.pop(v)
+                except KeyError:
+                    return None
+            loops.append(loop)
+        return loops
+        
+    def addBottomCap(self):
+        """
+        Closes a top surface whose boundary lies at z=0 with a flat bottom at z=0 that uses only 
+        the boundary vertices. Falls back to addMirror(flatten=True) if the boundary cannot be 
+        triangulated.
+        """
+        loops = self.getBoundaryLoops()
+        v = self.vertices
+        if loops is None or any(v[3*i+2] != 0. for loop in loops for i in loop):
+            self.addMirror(flatten=True)
+            return
+        xy = {}
+        for loop in loops:
+            for i in loop:
+                xy[i] = (v[3*i], v[3*i+1])
+        outers = []
+        holes = []
+        for loop in loops:
+            area = _ringArea(xy, loop)
+            if area > 0:
+                outers.append((area,loop,[]))
+            elif area < 0:
+                holes.append(loop)
+        outers.sort(key=lambda o : o[0])
+        for hole in holes:
+            # the smallest outline around a hole is the one it belongs to
+            for area,outer,outerHoles in outers:
+                if _insideRing(xy, outer, xy[hole[0]]):
+                    outerHoles.append(hole)
+                    break
+            else:
+                self.addMirror(flatten=True)
+                return
+        cap = []
+        for area,outer,outerHoles in outers:
+            triangles = triangulatePolygon(xy, outer, outerHoles)
+            if triangles is None:
+                self.addMirror(flatten=True)
+                return
+            cap += triangles
+        for a,b,c in cap:
+            self.addFace(c,b,a)
+
+    def toColorTriangleList(self):
+        return [ (self.color, triangle) for triangle in self.getTriangles() ]
+
+def isIndexedMesh(polys):
+    return isinstance(polys, IndexedMesh)
+
+def indexedMeshFromTriangles(triangles, color=None):
+    """
+    Builds an IndexedMesh from an iterable of triangles, merging vertices with identical coordinates.
+    """
+    mesh = IndexedMesh(color=color)
+    index = {}
+    for triangle in triangles:
+        face = []
+        for v in triangle:
+            key = (v[0], v[1], v[2])
+            try:
+                i = index[key]
+            except KeyError:
+                i = mesh.addVertex(*key)
+                index[key] = i
+            face.append(i)
+        mesh.addFace(*face)
+    return mesh
+
+def _cross(ax, ay, bx, by):
+    return ax * by - ay * bx
+
+def _area(xy, a, b, c):
+    # twice the signed area of triangle abc; positive when counterclockwise
+    ax,ay = xy[a]
+    bx,by = xy[b]
+    cx,cy = xy[c]
+    return (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+
+def _segmentsTouch(p1, p2, q1, q2):
+    # conservative: collinear overlaps and shared endpoints count as touching
+    d1 = _cross(q2[0]-q1[0], q2[1]-q1[1], p1[0]-q1[0], p1[1]-q1[1])
+    d2 = _cross(q2[0]-q1[0], q2[1]-q1[1], p2[0]-q1[0], p2[1]-q1[1])
+    d3 = _cross(p2[0]-p1[0], p2[1]-p1[1], q1[0]-p1[0], q1[1]-p1[1])
+    d4 = _cross(p2[0]-p1[0], p2[1]-p1[1], q2[0]-p1[0], q2[1]-p1[1])
+    if ((d1 > 0 and d2 > 0) or (d1 < 0 and d2 < 0) or (d3 > 0 and d4 > 0) or (d3 < 0 and d4 < 0)):
+        return False
+    if d1 == d2 == 0.:
+        # collinear: check for overlap of the projections
+        for axis in range(2):
+            if max(p1[axis],p2[axis]) < min(q1[axis],q2[axis]) or max(q1[axis],q2[axis]) < min(p1[axis],p2[axis]):
+                return False
+    return True
+
+def _insideRing(xy, ring, point):
+    x,y = point
+    inside = False
+    for i in range(len(ring)):
+        ax,ay = xy[ring[i-1]]
+        bx,by = xy[ring[i]]
+        if (ay > y) != (by > y) and x < ax + (y - ay) * (bx - ax) / (by - ay):
+            inside = not inside
+    return inside
+
+def _ringArea(xy, ring):
+    return sum(_cross(xy[ring[i-1]][0], xy[ring[i-1]][1], xy[ring[i]][0], xy[ring[i]][1]) for i in range(len(ring)))
+
+def _bridgeHole(xy, ring, hole, otherRings):
+    """
+    Splices a clockwise hole into a counterclockwise ring through a bridge from the hole's
+    rightmost vertex to the nearest ring vertex that it can see. Returns None if there is none.
+    """
+    h = max(range(len(hole)), key=lambda i : xy[hole[i]])
+    hp = xy[hole[h]]
+    candidates = sorted(range(len(ring)), key=lambda i : (xy[ring[i]][0]-hp[0])**2 + (xy[ring[i]][1]-hp[1])**2)
+    edges = [ (r[i-1],r[i]) for r in [ring, hole] + otherRings for i in range(len(r)) ]
+    for m in candidates:
+        mp = xy[ring[m]]
+        if mp == hp:
+            continue
+        # the bridge must leave m into the ring's interior...
+        ax,ay = xy[ring[m-1]]
+        bx,by = xy[ring[(m+1) % len(ring)]]
+        e0 = (ax-mp[0], ay-mp[1])
+        e1 = (bx-mp[0], by-mp[1])
+        d = (hp[0]-mp[0], hp[1]-mp[1])
+        if _cross(e1[0], e1[1], e0[0], e0[1]) > 0:
+            if not (_cross(e1[0], e1[1], d[0], d[1]) > 0 and _cross(d[0], d[1], e0[0], e0[1]) > 0):
+                continue
+        elif _cross(e0[0], e0[1], d[0], d[1]) >= 0 and _cross(d[0], d[1], e1[0], e1[1]) >= 0:
+            continue
+        # ...and cross no edge that does not end at one of its endpoints
+        for a,b in edges:
+            pa = xy[a]
+            pb = xy[b]
+            if pa == mp or pb == mp or pa == hp or pb == hp:
+                continue
+            if _segmentsTouch(mp, hp, pa, pb):
+                break
+        else:
+            return ring[:m+1] + hole[h:] + hole[:h+1] + ring[m:]
+    return None
+
+def triangulatePolygon(xy, outer, holes=[]):
+    """
+    Ear-clipping triangulation of a polygon with holes.
+    
+    xy: mapping from vertex index to (x,y) coordinates
+    outer: counterclockwise list of vertex indices
+    holes: list of clockwise lists of vertex indices
+    
+    Returns a list of counterclockwise (a,b,c) vertex index triangles using every vertex of the
+    outline (so that they match up with the edges of whatever shares the outline), or None if
+    the outline is too degenerate.
+    """
+    ring = list(outer)
+    holes = sorted(holes, key=lambda hole : -max(xy[i][0] for i in hole))
+    for k,hole in enumerate(holes):
+        ring = _bridgeHole(xy, ring, hole, holes[k+1:])
+        if ring is None:
+            return None
+            
+    n = len(ring)
+    prev = [i-1 for i in range(n)]
+    prev[0] = n-1
+    next = [i+1 for i in range(n)]
+    next[n-1] = 0
+    
+    def convex(i):
+        return _area(xy, ring[prev[i]], ring[i], ring[next[i]]) > 0
+        
+    notConvex = set(i for i in range(n) if not convex(i))
+    
+    def isEar(i):
+        p = prev[i]
+        q = next[i]
+        if i in notConvex:
+            return False
+        corners = (xy[ring[p]], xy[ring[i]], xy[ring[q]])
+        for j in notConvex:
+            r = xy[ring[j]]
+            if r in corners:
+                continue
+            if ( _area(xy, ring[p], ring[i], ring[j]) >= 0 and _area(xy, ring[i], ring[q], ring[j]) >= 0 and
+                    _area(xy, ring[q], ring[p], ring[j]) >= 0 ):
+                return False
+        return True
+        
+    triangles = []
+    remaining = n
+    i = 0
+    stalled = 0
+    while remaining > 3:
+        if isEar(i):
+            p = prev[i]
+            q = next[i]
+            triangles.append((ring[p], ring[i], ring[q]))
+            next[p] = q
+            prev[q] = p
+            remaining -= 1
+            for j in (p,q):
+                if convex(j):
+                    notConvex.discard(j)
+                else:
+                    notConvex.add(j)
+            notConvex.discard(i)
+            i = q
+            stalled = 0
+        else:
+            i = next[i]
+            stalled += 1
+            if stalled > remaining:
+                return None
+    if not convex(i):
+        return None
+    triangles.append((ring[prev[i]], ring[i], ring[next[i]]))
+    return triangles
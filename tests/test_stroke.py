@@ -0,0 +1,40 @@
+from __future__ import division
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import inflateutils.svgpath.parser as parser
+
+# 200 user units on a 100mm page, so one unit is half a millimeter
+SVG = b"""<svg xmlns="http://www.w3.org/2000/svg" width="100mm" height="100mm" viewBox="0 0 200 200">
+<g transform="scale(2)" style="stroke:#f00;stroke-width:3">
+ <rect id="outer" x="5" y="5" width="20" height="10"/>
+ <g transform="scale(0.5)">
+  <g>
+   <circle id="nested" cx="30" cy="30" r="10" stroke-width="4"/>
+  </g>
+  <path id="fixed" d="M 0 0 L 10 0 L 10 10 z" vector-effect="non-scaling-stroke"/>
+ </g>
+</g>
+<path id="plain" d="M 100 100 L 120 100 L 110 120 z" stroke="black"/>
+</svg>"""
+
+class StrokeWidthTest(unittest.TestCase):
+    def setUp(self):
+        paths, lowerLeft, upperRight = parser.getPathsFromSVGFile(io.BytesIO(SVG))
+        self.widths = [ path.svgState.strokeWidth for path in paths ]
+        
+    def testScaledOnce(self):
+        # the width is scaled by the shape's own matrix however deeply it is nested
+        self.assertAlmostEqual(self.widths[0], 3.)
+        self.assertAlmostEqual(self.widths[1], 2.)
+        self.assertAlmostEqual(self.widths[3], 0.05)
+        
+    def testNonScalingStroke(self):
+        self.assertAlmostEqual(self.widths[2], 3.)
+        
+if __name__ == '__main__':
+    unittest.main()